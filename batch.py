@@ -0,0 +1,80 @@
+import glob
+import os
+import time
+
+
+def is_batch(pattern:str) -> bool:
+  return os.path.isdir(pattern) or any(c in pattern for c in "*?[")
+
+
+def expand_paths(pattern:str, suffix:str) -> list:
+  """
+  file, directory (files ending with suffix) or glob -> paths
+  """
+  if os.path.isdir(pattern):
+    return sorted(glob.glob(os.path.join(glob.escape(pattern), "*" + suffix)))
+  if is_batch(pattern):
+    return sorted(glob.glob(pattern, recursive=True))
+  return [pattern]
+
+
+def output_path(src:str, out_dir:str, strip:str, suffix:str) -> str:
+  """
+  course.kmp -> (out_dir or same directory)/course.kmp.xlsx
+  """
+  name = os.path.basename(src)
+  if strip and name.endswith(strip):
+    name = name[:-len(strip)]
+  return os.path.join(out_dir if out_dir else os.path.dirname(src), name + suffix)
+
+
+def convert(func, src:str, dest:str, overwrite:bool, *args) -> tuple:
+  """
+  Run func(src, dest, *args) and return (src, dest, error or None, seconds).
+  """
+  start = time.perf_counter()
+  try:
+    if not overwrite and os.path.exists(dest):
+      raise FileExistsError(dest + " arleady exists.")
+    func(src, dest, *args)
+    error = None
+  except Exception as e:
+    error = type(e).__name__ + ": " + str(e)
+  return src, dest, error, time.perf_counter()-start
+
+
+def report(result:tuple):
+  src, dest, error, seconds = result
+  if error is None:
+    print(f"{src} -> {dest} ({seconds:.2f}s)")
+  else:
+    print(f"{src} : FAILED ({error})")
+
+
+def run_batch(func, pairs:list, jobs:int=1, overwrite:bool=False, args:tuple=()) -> list:
+  """
+  Convert [(src, dest)] with func on a process pool of jobs workers.
+  A failed file is reported and does not stop the batch.
+  """
+  start = time.perf_counter()
+  results = []
+  if jobs <= 1:
+    for src, dest in pairs:
+      results.append(convert(func, src, dest, overwrite, *args))
+      report(results[-1])
+  else:
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+      futures = {pool.submit(convert, func, src, dest, overwrite, *args): (src, dest) for src, dest in pairs}
+      for future in as_completed(futures):
+        try:
+          results.append(future.result())
+        except Exception as e: # worker died
+          results.append(futures[future] + (type(e).__name__ + ": " + str(e), 0.0))
+        report(results[-1])
+
+  failed = [x for x in results if x[2] is not None]
+  print(f"{len(results)-len(failed)} converted, {len(failed)} failed ({time.perf_counter()-start:.2f}s)")
+  for src, dest, error, seconds in failed:
+    print(f"  {src} : {error}")
+  return results
@@ -0,0 +1,368 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from binfunc import MappedParser, encode_xpf
+from k2x import iter_frames
+from routes import PathGraph
+from schema import CONVERTER_VERSION, POTI_ROUTE, RECORDS, SECTION_HEADER, SHEETS, XPF_OBJECTS, XPF_PRESENCE
+from szs import yaz0_compress, yaz0_decompress
+from tables import iter_tables, write_excel
+from x2k import build_kmp, encode_sheet
+
+
+# entries per section (POTI : routes, POTI points : points per route)
+# ENPT, ITPT and CKPT are limited to 255 points (paths store byte indexes).
+DEFAULT_COUNTS = {
+    "KTPT": 12, "ENPT": 255, "ENPH": 32, "ITPT": 255, "ITPH": 32, "CKPT": 255, "CKPH": 32,
+    "GOBJ": 5000, "POTI": 200, "POTI points": 20, "AREA": 1000, "CAME": 100,
+    "JGPT": 255, "CNPT": 16, "MSPT": 12}
+
+
+def random_columns(record, count:int, rng) -> dict:
+  columns = {}
+  for key, fmt in record.fields:
+    if fmt == "f":
+      columns[key] = rng.uniform(-1e4, 1e4, count).astype(np.float32)
+    else:
+      info = np.iinfo(record.dtype[key])
+      columns[key] = rng.integers(info.min, int(info.max)+1, count)
+  return columns
+
+
+def random_links(targets:int, no_link:int, count:int, rng):
+  """
+  -> count references to one of targets entries or no_link
+  """
+  n = min(targets, no_link)
+  links = rng.integers(0, n+1, count)
+  links[links == n] = no_link
+  return links
+
+
+def path_groups(points:int, groups:int, rng) -> tuple:
+  """
+  points -> (group starts, group lengths), every group has at least one point
+  """
+  groups = max(1, min(groups, points, 255))
+  cuts = np.sort(rng.choice(np.arange(1, points), groups-1, replace=False)) if groups > 1 else []
+  starts = np.concatenate([[0], cuts]).astype(np.int64)
+  return starts, np.diff(np.concatenate([starts, [points]]))
+
+
+def section(name:str, count:int, data:bytes, option:int=0) -> bytes:
+  return SECTION_HEADER.pack(name.encode("utf-8"), count, option) + data
+
+
+def synthetic_kmp(counts:dict=None, seed:int=0) -> bytes:
+  """
+  Valid KMP with random content, counts : entries per section (see DEFAULT_COUNTS)
+  Values are canonical (x2k writes the same bytes back), references are in range (validate.LINKS).
+  """
+  counts = dict(DEFAULT_COUNTS, **(counts or {}))
+  rng = np.random.default_rng(seed)
+  routes = counts.get("POTI", 1)
+  cameras = max(1, min(counts.get("CAME", 1), 255))
+  enemies = max(1, min(counts.get("ENPT", 1), 255))
+  sections = []
+  for name, record in RECORDS.items():
+    if name in ["ENPH", "ITPH", "CKPH"]:
+      continue
+    count = counts.get(name, 1)
+    if name in ["ENPT", "ITPT", "CKPT", "CAME"]:
+      count = max(1, min(count, 255))
+    elif name == "STGI":
+      count = 1
+    columns = random_columns(record, count, rng)
+    option = 0
+
+    if name in ["ENPT", "ITPT", "CKPT"]:
+      ph = name[:3] + "H"
+      starts, lengths = path_groups(count, counts[ph], rng)
+      if name == "CKPT":
+        columns["Prev"], columns["Next"] = PathGraph(starts, lengths, count).ckpt_links()
+        # 255 : no respawn point (no JGPT)
+        columns["Respawn"] = rng.integers(0, counts["JGPT"], count) if counts["JGPT"] > 0 else np.full(count, 255)
+      for key, fmt in record.fields:
+        if key.startswith("_pad"):
+          columns[key] = np.zeros(count, np.int64)
+      sections.append(section(name, count, record.encode(columns, count)))
+
+      groups = len(starts)
+      paths = random_columns(RECORDS[ph], groups, rng)
+      paths["_start"], paths["_length"] = starts, lengths
+      for i in range(6):
+        paths["Last %d" % (i+1)] = (np.arange(groups)-1) % groups if i == 0 else np.full(groups, 255)
+        paths["Next %d" % (i+1)] = (np.arange(groups)+1) % groups if i == 0 else np.full(groups, 255)
+      if ph != "ENPH":
+        paths["_pad"] = np.zeros(groups, np.int64)
+      sections.append(section(ph, groups, RECORDS[ph].encode(paths, groups)))
+      continue
+
+    if name == "GOBJ":
+      xpf = {key: rng.integers(0, 1 << bits, count) for key, _, bits in XPF_OBJECTS + XPF_PRESENCE}
+      columns["_objects"], columns["_presence"] = encode_xpf(xpf)
+      columns["Route"] = random_links(routes, 0xFFFF, count, rng)
+    elif name == "AREA":
+      columns["Camera"] = random_links(cameras, 255, count, rng)
+      columns["Route"] = random_links(routes, 255, count, rng)
+      columns["Enemy"] = random_links(enemies, 255, count, rng)
+    elif name == "POTI":
+      data = b""
+      points = counts["POTI points"]
+      for i in range(count):
+        route = random_columns(POTI_ROUTE, 1, rng)
+        route["_points"] = [points]
+        data += POTI_ROUTE.encode(route, 1)
+        data += RECORDS["POTI"].encode(random_columns(RECORDS["POTI"], points, rng), points)
+      sections.append(section(name, count, data, count*points))
+      continue
+    elif name == "CAME":
+      columns["Next"] = rng.integers(0, count, count)
+      columns["Route"] = random_links(routes, 255, count, rng)
+      option = (int(rng.integers(0, count)) << 8) + int(rng.integers(0, count))
+    elif name == "STGI":
+      columns["_speed"] = [0x3F80] # 1.0
+    for key, fmt in record.fields:
+      if key.startswith("_pad"):
+        columns[key] = np.zeros(count, np.int64)
+    sections.append(section(name, count, record.encode(columns, count), option))
+  return build_kmp(sections)
+
+
+def count_entries(path:str) -> int:
+  with open(path, "rb") as f, MappedParser(f) as parser:
+    return sum([x[1] + (x[2] if x[0] == "POTI" else 0) for x in parser.sections()])
+
+
+def parse_only(path:str):
+  """
+  binary parse phase of k2x (all sections decoded, no DataFrame)
+  """
+  arrays = []
+  with open(path, "rb") as f, MappedParser(f) as parser:
+    for name, entry, option, address, end in parser.sections():
+      if name == "POTI":
+        arrays += [x.copy() for x in parser.read_routes(entry, address, end)]
+      else:
+        arrays.append(parser.read_entries(RECORDS[name], entry, address, end).copy())
+  return arrays
+
+
+def xlsx_sheet_sizes(path:str) -> dict:
+  """
+  xlsx -> {sheet: uncompressed bytes of its worksheet XML}
+  """
+  import posixpath
+  import xml.etree.ElementTree as ET
+  import zipfile
+  main = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+  rel = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+  with zipfile.ZipFile(path) as z:
+    workbook = ET.fromstring(z.read("xl/workbook.xml"))
+    rels = ET.fromstring(z.read("xl/_rels/workbook.xml.rels"))
+    targets = {x.get("Id"): x.get("Target") for x in rels}
+    sizes = {}
+    for sheet in workbook.iter(main + "sheet"):
+      target = targets[sheet.get(rel + "id")]
+      member = target.lstrip("/") if target.startswith("/") else posixpath.join("xl", target)
+      sizes[sheet.get("name")] = z.getinfo(member).file_size
+  return sizes
+
+
+def read_encode(path:str, sheets:list, engine:str=None) -> list:
+  """
+  worker : read the sheets (one workbook load) and encode them -> [(sheet, [section bytes])]
+  """
+  return [(sheet, encode_sheet(sheet, table)) for sheet, table in iter_tables(path, sheets, "xlsx", engine)]
+
+
+def parallel_read_encode(path:str, jobs:int, engine:str=None) -> bytes:
+  """
+  x2k read and encode on jobs processes, each reads a group of sheets of about the same XML size
+  """
+  from concurrent.futures import ProcessPoolExecutor
+  sizes = xlsx_sheet_sizes(path)
+  groups, loads = [[] for i in range(jobs)], [0]*jobs
+  for sheet in sorted(SHEETS, key=lambda x: -sizes.get(x, 0)):
+    i = loads.index(min(loads))
+    groups[i].append(sheet)
+    loads[i] += sizes.get(sheet, 0)
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    encoded = dict([x for result in pool.map(read_encode, [path]*jobs, groups, [engine]*jobs) for x in result])
+  return build_kmp(sum([encoded[sheet] for sheet in SHEETS], []))
+
+
+def timeit(func, repeat:int) -> tuple:
+  """
+  -> (best seconds, median seconds, last result)
+  """
+  times = []
+  for i in range(repeat):
+    start = time.perf_counter()
+    result = func()
+    times.append(time.perf_counter()-start)
+  return min(times), float(np.median(times)), result
+
+
+def run(counts:dict, repeat:int=3, seed:int=0, engine:str=None, jobs:int=1) -> dict:
+  """
+  jobs > 1 : also time the x2k read and encode of the sheets on jobs processes against the serial one
+  """
+  workdir = tempfile.mkdtemp(prefix="k2x_bench_")
+  kmp = os.path.join(workdir, "bench.kmp")
+  xlsx = kmp + ".xlsx"
+  with open(kmp, "wb") as f:
+    f.write(synthetic_kmp(counts, seed))
+  entries = count_entries(kmp)
+  kmp_size = os.path.getsize(kmp)
+
+  phases = {}
+  def record(phase:str, func, size:int=None):
+    best, median, result = timeit(func, repeat)
+    phases[phase] = {"seconds": best, "median": median, "entries_per_s": entries/best}
+    if size is not None:
+      phases[phase]["mb_per_s"] = size/best/1e6
+    return result
+
+  record("k2x.parse", lambda: parse_only(kmp), kmp_size)
+  frames = record("k2x.parse+dataframe", lambda: list(iter_frames(kmp)), kmp_size)
+  record("k2x.excel_write", lambda: write_excel(frames, xlsx))
+  xlsx_size = os.path.getsize(xlsx)
+  phases["k2x.excel_write"]["mb_per_s"] = xlsx_size/phases["k2x.excel_write"]["seconds"]/1e6
+  tables = record("x2k.excel_read", lambda: list(iter_tables(xlsx, list(SHEETS.keys()), "xlsx", engine)), xlsx_size)
+  encode = lambda: build_kmp(sum([encode_sheet(sheet, table) for sheet, table in tables], []))
+  data = record("x2k.encode", encode, kmp_size)
+  results = [data]
+  if jobs > 1:
+    serial = lambda: build_kmp(sum([encode_sheet(sheet, table) for sheet, table in iter_tables(
+        xlsx, list(SHEETS.keys()), "xlsx", engine)], []))
+    results.append(record("x2k.read+encode", serial, xlsx_size))
+    results.append(record(f"x2k.read+encode j{jobs}", lambda: parallel_read_encode(xlsx, jobs, engine), xlsx_size))
+
+  with open(kmp, "rb") as f:
+    original = f.read()
+  roundtrip = all([x == original for x in results])
+  compressed = yaz0_compress(data)
+  record("yaz0.decompress", lambda: yaz0_decompress(compressed), kmp_size)
+  for path in [kmp, xlsx]:
+    os.remove(path)
+  os.rmdir(workdir)
+  return {
+      "counts": dict(DEFAULT_COUNTS, **counts), "entries": entries, "kmp_bytes": kmp_size,
+      "xlsx_bytes": xlsx_size, "repeat": repeat, "roundtrip": roundtrip, "phases": phases}
+
+
+# command lines timed by startup (run from the repository directory)
+STARTUP = OrderedDict([
+    ("python", ["-c", "pass"]),
+    ("import kmpfile", ["-c", "import kmpfile"]),
+    ("import k2x", ["-c", "import k2x"]),
+    ("import x2k", ["-c", "import x2k"]),
+    ("k2x --stats", ["k2x.py", "--stats", "--kmp"]),
+    ("import numpy", ["-c", "import numpy"]),
+    ("import pandas", ["-c", "import pandas"])])
+
+
+def startup(kmp:str, repeat:int=5) -> dict:
+  """
+  -> {command: best seconds of a new interpreter}
+  """
+  cwd = os.path.dirname(os.path.abspath(__file__))
+  result = {}
+  for name, args in STARTUP.items():
+    args = [sys.executable] + args + ([kmp] if args[-1] == "--kmp" else [])
+    best, median, _ = timeit(lambda: subprocess.run(args, cwd=cwd, check=True, stdout=subprocess.DEVNULL), repeat)
+    result[name] = {"seconds": best, "median": median}
+  return result
+
+
+def environment() -> dict:
+  import numpy
+  import openpyxl
+  import pandas
+  return {
+      "converter": CONVERTER_VERSION, "python": platform.python_version(), "platform": platform.platform(),
+      "cpus": os.cpu_count(),
+      "numpy": numpy.__version__, "pandas": pandas.__version__, "openpyxl": openpyxl.__version__}
+
+
+def compare(result:dict, baseline:dict, tolerance:float) -> list:
+  """
+  -> [phases slower than baseline by more than tolerance]
+  """
+  slower = []
+  for group in ["phases", "startup"]:
+    for phase, x in result.get(group, {}).items():
+      if phase not in baseline.get(group, {}):
+        continue
+      base = baseline[group][phase]["seconds"]
+      ratio = x["seconds"] / base
+      name = phase if group == "phases" else "startup " + phase
+      print(f"{name:24s} {base:9.4f}s -> {x['seconds']:9.4f}s (x{ratio:.2f})")
+      if ratio > 1 + tolerance:
+        slower.append(name)
+  return slower
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  for name, count in DEFAULT_COUNTS.items():
+    parser.add_argument('--' + name.lower().replace(" ", "-"), type=int, default=count,
+        help=f'{name} entries (default: {count})')
+  parser.add_argument('--repeat', type=int, default=3, help='Runs per phase (best is reported)')
+  parser.add_argument('--seed', type=int, default=0, help='Random seed of the synthetic KMP')
+  parser.add_argument('--engine', default=None, choices=['openpyxl', 'calamine'], help='Excel reader')
+  parser.add_argument('--output', default=None, help='Result JSON path')
+  parser.add_argument('--compare', default=None, help='Baseline result JSON to compare with')
+  parser.add_argument('--tolerance', type=float, default=0.2,
+      help='Allowed slowdown against --compare (0.2 = 20%%)')
+  parser.add_argument('--synthetic', default=None, help='Only write a synthetic KMP to this path')
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+      help='Also time x2k reading and encoding the sheets on this many processes (against the serial path)')
+  parser.add_argument('--startup', action='store_true',
+      help='Also time new interpreters (imports and k2x --stats)')
+
+  arg = parser.parse_args()
+  counts = {name: getattr(arg, name.lower().replace(" ", "_")) for name in DEFAULT_COUNTS}
+
+  if arg.synthetic is not None:
+    with open(arg.synthetic, "wb") as f:
+      f.write(synthetic_kmp(counts, arg.seed))
+    sys.exit(0)
+
+  result = run(counts, arg.repeat, arg.seed, arg.engine, arg.jobs)
+  if arg.startup:
+    kmp = os.path.join(tempfile.mkdtemp(prefix="k2x_bench_"), "bench.kmp")
+    with open(kmp, "wb") as f:
+      f.write(synthetic_kmp(counts, arg.seed))
+    result["startup"] = startup(kmp, arg.repeat)
+    os.remove(kmp)
+    os.rmdir(os.path.dirname(kmp))
+  result["environment"] = environment()
+  print(f"{result['entries']} entries, {result['kmp_bytes']} bytes (kmp), {result['xlsx_bytes']} bytes (xlsx)")
+  for phase, x in result["phases"].items():
+    print(f"{phase:24s} {x['seconds']:9.4f}s {x['entries_per_s']:12.0f} entries/s {x.get('mb_per_s', 0):8.2f} MB/s")
+  for name, x in result.get("startup", {}).items():
+    print(f"{'startup ' + name:24s} {x['seconds']:9.4f}s")
+  if not result["roundtrip"]:
+    print("warning: x2k output differs from the synthetic KMP")
+
+  if arg.output is not None:
+    with open(arg.output, "w") as f:
+      json.dump(result, f, indent=2)
+
+  if arg.compare is not None:
+    with open(arg.compare) as f:
+      slower = compare(result, json.load(f), arg.tolerance)
+    if len(slower) > 0:
+      print("slower : " + ", ".join(slower))
+      sys.exit(1)
@@ -1,21 +1,27 @@
+import mmap
+from contextlib import contextmanager
 from binascii import unhexlify
 from io import BufferedReader, BufferedWriter
-from struct import pack, unpack
+from struct import error as struct_error
+from struct import pack, pack_into, unpack, unpack_from
 
-import numpy as np
+import profiling
+from schema import FILE_HEADER, POTI_ROUTE, RECORDS, SECTION_HEADER, XPF_OBJECTS, XPF_PRESENCE
+from szs import is_archive, szs_kmp
 
 
-def unpack_16bits(num, cut=0) -> np.ndarray:
+def unpack_16bits(num, cut=0):
   # np.unpackbits not supported uint16
+  import numpy as np
   x = np.array([num], np.uint16)
   p = np.power(2, np.arange(16))[::-1]
-  x = (x&p).astype(np.bool).astype(np.uint8)
+  x = ((x&p) != 0).astype(np.uint8)
   if cut != 0:
     x = x[cut:]
   return x
 
 
-def unpack_8bits(num, cut=0) -> np.ndarray:
+def unpack_8bits(num, cut=0):
   # faster than np.packbits
   if num>255:
     raise OverflowError(unpack_8bits.__name__ + ' not supported int16.')
@@ -24,6 +30,7 @@ def unpack_8bits(num, cut=0) -> np.ndarray:
 
 def pack_16bits(arr) -> int:
   # np.packbits not supported uint16
+  import numpy as np
   if isinstance(arr, list):
     x = np.array(arr, np.uint8)
   else:
@@ -40,6 +47,103 @@ def pack_8bits(arr) -> int:
   return pack_16bits(arr)
 
 
+def int_column(values):
+  import numpy as np
+  values = np.asarray(values, np.float64)
+  if np.isnan(values).any():
+    raise ValueError("Integer column has empty cells.")
+  return values.astype(np.int64)
+
+
+def unpack_fields(words, layout:list) -> dict:
+  """
+  uint16 array -> {column: array} for [(column, shift, bits)]
+  """
+  import numpy as np
+  words = np.asarray(words).astype(np.int64)
+  return {clm: (words >> shift) & ((1 << bits) - 1) for clm, shift, bits in layout}
+
+
+def pack_fields(columns:dict, layout:list):
+  """
+  {column: array} -> uint16 array for [(column, shift, bits)]
+  """
+  import numpy as np
+  words = 0
+  for clm, shift, bits in layout:
+    words = words | ((int_column(columns[clm]) & ((1 << bits) - 1)) << shift)
+  return np.asarray(words, np.int64).astype(np.uint16)
+
+
+def decode_xpf(objects, presence) -> dict:
+  """
+  GOBJ 0x00 and 0x3A (uint16 arrays) -> XPF columns (Type(LE) ... Single)
+  """
+  columns = unpack_fields(objects, XPF_OBJECTS)
+  columns.update(unpack_fields(presence, XPF_PRESENCE))
+  return columns
+
+
+def encode_xpf(columns:dict) -> tuple:
+  """
+  XPF columns -> (GOBJ 0x00, GOBJ 0x3A) uint16 arrays
+  Definition object, enable and Parameters are written only with LE_CODE (MODE>0).
+  """
+  import numpy as np
+  mode = int_column(columns["MODE"])
+  le_code = mode != 0
+  params = int_column(columns["Parameters"])
+  objects = {
+      "Type(LE)": np.where(le_code, int_column(columns["Type(LE)"]), 0),
+      "Enable(LE)": le_code & (int_column(columns["Enable(LE)"]) != 0),
+      "Object": columns["Object"]}
+  presence = {clm: int_column(columns[clm]) != 0 for clm, _, _ in XPF_PRESENCE[2:]}
+  presence["MODE"] = mode
+  presence["Parameters"] = np.where(le_code & (params <= 63), params, 0)
+  return pack_fields(objects, XPF_OBJECTS), pack_fields(presence, XPF_PRESENCE)
+
+
+def parse_objects(num) -> list:
+  """
+  GOBJ 0x00 (uint16) -> [Type(definition object), disable or enable, object ID]
+  """
+  columns = unpack_fields([num], XPF_OBJECTS)
+  return [int(columns[clm][0]) for clm, _, _ in XPF_OBJECTS]
+
+
+def parse_presence(num) -> list:
+  """
+  GOBJ 0x3A (uint16) -> [MODE, Parameters, Presence flag(LSB 3bits)]
+  """
+  columns = unpack_fields([num], XPF_PRESENCE)
+  return [int(columns[clm][0]) for clm, _, _ in XPF_PRESENCE]
+
+
+def build_objects(data:list, LE_CODE:bool) -> int:
+  """
+  [Type(definition object), disable or enable, object ID] -> GOBJ 0x00 (uint16)
+  """
+  columns = dict(zip([clm for clm, _, _ in XPF_OBJECTS], [[x] for x in data]))
+  columns.update({"MODE": [int(LE_CODE)], "Parameters": [0], "Multi(>2)": [0], "Multi(<3)": [0], "Single": [0]})
+  return int(encode_xpf(columns)[0][0])
+
+
+def build_presence(data:list) -> int:
+  """
+  [MODE, Parameters, Presence flag(3bits)] -> GOBJ 0x3A (uint16)
+  """
+  columns = dict(zip([clm for clm, _, _ in XPF_PRESENCE], [[x] for x in data]))
+  columns.update({"Type(LE)": [0], "Enable(LE)": [0], "Object": [0]})
+  return int(encode_xpf(columns)[1][0])
+
+
+def native_columns(arr) -> dict:
+  """
+  Structured array -> {field name: native-endian copy}
+  """
+  return {name: arr[name].astype(arr.dtype[name].newbyteorder("=")) for name in arr.dtype.names}
+
+
 class BinaryParser(object):
   def __init__(self, file):
     if not isinstance(file, BufferedReader):
@@ -143,10 +247,7 @@ class BinaryParser(object):
 
     Source : http://wiki.tockdom.com/wiki/Extended_presence_flags\/Technical_Description#Definition_Objects
     """
-    x = self.bytes_to_bitarray
-    object_id = pack_16bits(x[6:])
-    op = pack_16bits(x[:3])
-    return [op, x[3], object_id]
+    return parse_objects(self.read_uint16)
 
   @property
   def read_reference(self) -> str:
@@ -168,10 +269,100 @@ class BinaryParser(object):
 
     Source : http://wiki.tockdom.com/wiki/Extended_presence_flags/Technical_Description#Presence_flag_.28and_MODE.29
     """
-    x = self.bytes_to_bitarray
-    mode = pack_16bits(x[:4])
-    param = pack_8bits(x[4:10])
-    return np.hstack([mode, param, x[-3:]]).tolist()
+    return parse_presence(self.read_uint16)
+
+
+class MappedParser(object):
+  """
+  Memory-mapped KMP reader.
+  Each section is sliced with the header offset table and decoded at once.
+  file : BufferReader (mapped) or bytes-like object (used as is)
+  """
+  def __init__(self, file):
+    if isinstance(file, BufferedReader):
+      self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    elif isinstance(file, (bytes, bytearray, memoryview)):
+      self.mm = None
+    else:
+      raise ValueError("'file' must be BufferReader or bytes.")
+    self.buffer = memoryview(file if self.mm is None else self.mm)
+
+    if len(self.buffer) < FILE_HEADER.size or bytes(self.buffer[:4]) != b"RKMD":
+      self.close()
+      raise ValueError("Invalid file.")
+    _, self.file_length, sections, self.header_length, self.version = FILE_HEADER.unpack_from(self.buffer)
+    self.offsets = list(unpack_from(">%dI" % sections, self.buffer, FILE_HEADER.size))
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    try:
+      self.buffer.release()
+      if self.mm is not None:
+        self.mm.close()
+    except BufferError:
+      # decoded arrays are still alive, the map is closed when they are collected.
+      pass
+
+  def sections(self):
+    """
+    yield (section name, entry, header option(uint16), data address, end address)
+    """
+    heads = [head + self.header_length for head in self.offsets]
+    ends = sorted(heads + [min(self.file_length, len(self.buffer))])
+    for head in heads:
+      end = next((x for x in ends if x > head), len(self.buffer))
+      name, entry, option = SECTION_HEADER.unpack_from(self.buffer, head)
+      name = str(name, encoding="utf-8", errors="replace")
+      yield name, entry, option, head+SECTION_HEADER.size, end
+
+  def read_entries(self, record, entry, address, end):
+    """
+    entry * record (structured array, view of the mapped file)
+    """
+    if address + entry*record.size > end:
+      raise ValueError(record.name + " exceeds its section.")
+    profiling.count("read", entry*record.size)
+    return record.decode(self.buffer, entry, address)
+
+  def read_routes(self, entry, address, end):
+    """
+    POTI -> (route headers, points)
+    """
+    import numpy as np
+    routes = []
+    points = []
+    for i in range(entry):
+      route = self.read_entries(POTI_ROUTE, 1, address, end)
+      address += POTI_ROUTE.size
+      num = int(route["_points"][0])
+      routes.append(route)
+      points.append(self.read_entries(RECORDS["POTI"], num, address, end))
+      address += num * RECORDS["POTI"].size
+    if entry == 0:
+      return np.zeros(0, POTI_ROUTE.dtype), np.zeros(0, RECORDS["POTI"].dtype)
+    return np.concatenate(routes), np.concatenate(points)
+
+
+@contextmanager
+def open_kmp(source):
+  """
+  path, bytes or binary file-like object (KMP, or SZS / U8 archive holding it) -> MappedParser
+  """
+  if hasattr(source, "read") and not isinstance(source, BufferedReader):
+    source = source.read()
+  if is_archive(source):
+    source = szs_kmp(source)
+  if isinstance(source, (bytes, bytearray, memoryview, BufferedReader)):
+    with MappedParser(source) as parser:
+      yield parser
+  else:
+    with open(source, "rb") as f, MappedParser(f) as parser:
+      yield parser
 
 
 class BinaryWriter(object):
@@ -187,10 +378,14 @@ class BinaryWriter(object):
   def getaddress(self) -> int:
     return self.file.tell()
 
+  def write(self, data:bytes) -> int:
+    profiling.count("write", len(data))
+    return self.file.write(data)
+
   def write_int(self, num, write_bytes:int, signed:bool):
     if not isinstance(num, int):
       num = int(num)
-    return self.file.write(num.to_bytes(write_bytes, byteorder='big', signed=signed))
+    return self.write(num.to_bytes(write_bytes, byteorder='big', signed=signed))
 
   def write_byte(self, num):
     return self.write_int(num, 1, False)
@@ -205,54 +400,79 @@ class BinaryWriter(object):
     return self.write_int(num, 4, False)
 
   def write_float32(self, num:float):
-    return self.file.write(pack('>f', num))
+    return self.write(pack('>f', num))
+
+  def write_s(self, fmt:str, num:list):
+    """
+    Pack the whole list at once.
+    """
+    if fmt != "f":
+      num = [int(_num) for _num in num]
+    try:
+      return self.write(pack(">%d%s" % (len(num), fmt), *num))
+    except struct_error as e:
+      raise OverflowError(str(e))
   
   def write_byte_s(self, num:list):
-    for _num in num:
-      self.write_byte(_num)
+    return self.write_s("B", num)
 
   def write_uint16_s(self, num:list):
-    for _num in num:
-      self.write_uint16(_num)
+    return self.write_s("H", num)
 
   def write_uint32_s(self, num:list):
-    for _num in num:
-      self.write_uint32(_num)
+    return self.write_s("I", num)
 
   def write_float_s(self, num:list):
-    for _num in num:
-      self.write_float32(_num)
+    return self.write_s("f", num)
 
   def write_string(self, string:str):
-    self.file.write(string.encode('utf-8'))
+    self.write(string.encode('utf-8'))
 
   def write_float_half(self, num:float):
-    self.file.write(bytes(bytearray(pack('>f', num))[:2]))
+    self.write(bytes(bytearray(pack('>f', num))[:2]))
 
   def write_hex(self, value:str):
     x = value.encode("utf-8")
     self.write_uint16(int(x, 0))
 
   def write_objects(self, data:list, idx:int, LE_CODE:bool):
-    if LE_CODE:
-      definition = unpack_8bits(data[0], 5)
-      show = unpack_8bits(int(bool(data[1])), 7)
-    else:
-      definition = [0]*3
-      show = 0
-    object_id = unpack_16bits(data[2], 6)
-    c = np.hstack([definition, show, [0, 0], object_id]).astype(np.uint16)
-    c = int(pack_16bits(c))
-    self.write_uint16(c)
+    self.write_uint16(build_objects(data, LE_CODE))
 
   def write_reference(self, data:list):
-    if bool(data[0]): # LE_CODE (MODE>0)
-      mode = unpack_8bits(data[0], 4)
-      params = unpack_8bits(data[1], 2) if data[1]<=63 else [0]*6
-    else:
-      mode = [0]*4
-      params = [0]*6
-    player_mode = np.array(data[2:5]).astype(np.bool).astype(np.uint8)
-    c = np.hstack([mode, params, [0]*3, player_mode]).tolist()
-    c = pack_16bits(c)
-    self.write_uint16(c)
+    self.write_uint16(build_presence(data))
+
+  def write_record(self, record, columns:dict, count:int):
+    """
+    Write count entries of record at once.
+    """
+    return self.write(record.encode(columns, count))
+
+
+class BufferWriter(BinaryWriter):
+  """
+  BinaryWriter into one bytearray.
+  Header fields are patched in memory (pack_into) and the file is written at once (dump).
+  """
+  def __init__(self):
+    self.buffer = bytearray()
+
+  def seek(self, passed=0):
+    raise ValueError(BufferWriter.__name__ + " does not seek, use pack_into.")
+
+  @property
+  def getaddress(self) -> int:
+    return len(self.buffer)
+
+  def write(self, data:bytes) -> int:
+    profiling.count("write", len(data))
+    self.buffer += data
+    return len(data)
+
+  def pack_into(self, fmt:str, address:int, *values):
+    pack_into(fmt, self.buffer, address, *values)
+
+  def getvalue(self) -> bytes:
+    return bytes(self.buffer)
+
+  def dump(self, file) -> int:
+    return file.write(self.buffer)
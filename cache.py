@@ -0,0 +1,134 @@
+import hashlib
+import os
+import pickle
+import tempfile
+
+from schema import CONVERTER_VERSION
+
+
+# suffix of the files being written (never evicted : another process may still be writing them)
+TMP_SUFFIX = ".tmp"
+
+
+def file_digest(path:str) -> bytes:
+  """
+  file (or directory of tables) -> digest of its bytes
+  """
+  h = hashlib.blake2b(digest_size=20)
+  paths = [path]
+  if os.path.isdir(path):
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+  for p in paths:
+    h.update(os.path.basename(p).encode("utf-8"))
+    with open(p, "rb") as f:
+      for chunk in iter(lambda: f.read(1 << 20), b""):
+        h.update(chunk)
+  return h.digest()
+
+
+def table_digest(table:dict) -> bytes:
+  """
+  {column: array} -> digest of its content
+  """
+  import numpy as np
+  h = hashlib.blake2b(digest_size=20)
+  for clm, values in table.items():
+    h.update(clm.encode("utf-8") + b"\x00")
+    values = np.asarray(values)
+    if values.dtype.kind == "O":
+      h.update(repr(values.tolist()).encode("utf-8"))
+    else:
+      h.update(values.dtype.str.encode() + np.ascontiguousarray(values).tobytes())
+  return h.digest()
+
+
+class Cache(object):
+  """
+  On-disk content-addressed cache with size-bounded LRU eviction.
+  Entries are <directory>/<key[:2]>/<key>, their mtime is the last access.
+  The cache size is scanned on the first put and then counted, the directory is only walked again
+  to evict when it exceeds max_bytes (entries put by other processes are found then).
+  """
+  def __init__(self, directory:str, max_bytes:int=1 << 30):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    self.size = None
+
+  @staticmethod
+  def key(*parts) -> str:
+    h = hashlib.blake2b(CONVERTER_VERSION.encode("utf-8"), digest_size=20)
+    for part in parts:
+      h.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+      h.update(b"\x00")
+    return h.hexdigest()
+
+  def path(self, key:str) -> str:
+    return os.path.join(self.directory, key[:2], key)
+
+  def get(self, key:str):
+    """
+    key -> bytes (None if missing)
+    """
+    try:
+      with open(self.path(key), "rb") as f:
+        data = f.read()
+      os.utime(self.path(key))
+      return data
+    except FileNotFoundError:
+      return None
+
+  def put(self, key:str, data:bytes):
+    os.makedirs(os.path.dirname(self.path(key)), exist_ok=True)
+    if self.size is None:
+      self.size = sum([x[1] for x in self.entries()])
+    try:
+      self.size -= os.stat(self.path(key)).st_size
+    except FileNotFoundError:
+      pass
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path(key)), suffix=TMP_SUFFIX)
+    with os.fdopen(fd, "wb") as f:
+      f.write(data)
+    os.replace(tmp, self.path(key))
+    self.size += len(data)
+    if self.size > self.max_bytes:
+      self.evict()
+
+  def get_object(self, key:str):
+    data = self.get(key)
+    return None if data is None else pickle.loads(data)
+
+  def put_object(self, key:str, obj):
+    self.put(key, pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+  def entries(self) -> list:
+    """
+    -> [(mtime, size, path)] of the entries (files being written are skipped)
+    """
+    entries = []
+    for root, dirs, files in os.walk(self.directory):
+      for name in files:
+        if name.endswith(TMP_SUFFIX):
+          continue
+        try:
+          stat = os.stat(os.path.join(root, name))
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    return entries
+
+  def evict(self):
+    """
+    Remove least recently used entries until the cache fits in 90% of max_bytes
+    (the next puts do not walk the directory again right away).
+    """
+    entries = self.entries()
+    total = sum([x[1] for x in entries])
+    for mtime, size, path in sorted(entries):
+      if total <= self.max_bytes - self.max_bytes//10:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total -= size
+    self.size = total
@@ -0,0 +1,87 @@
+import json
+import os
+import socket
+import tempfile
+from struct import Struct
+
+
+# message : header length, payload length, JSON header, payload (inline bytes)
+MESSAGE = Struct(">II")
+
+
+def socket_path() -> str:
+  """
+  $K2X_SOCKET or <tmp>/k2x-<uid>.sock
+  """
+  if "K2X_SOCKET" in os.environ:
+    return os.environ["K2X_SOCKET"]
+  uid = os.getuid() if hasattr(os, "getuid") else 0
+  return os.path.join(tempfile.gettempdir(), "k2x-%d.sock" % uid)
+
+
+def pack_message(header:dict, payload:bytes=b"") -> bytes:
+  data = json.dumps(header).encode("utf-8")
+  return MESSAGE.pack(len(data), len(payload)) + data + payload
+
+
+def recv_exactly(sock, size:int) -> bytes:
+  buf = bytearray(size)
+  view = memoryview(buf)
+  while len(view) > 0:
+    n = sock.recv_into(view)
+    if n == 0:
+      raise ConnectionError("Connection closed by the daemon.")
+    view = view[n:]
+  return bytes(buf)
+
+
+def connect(path:str=None):
+  """
+  -> connected socket (None : no daemon is running, or the socket belongs to another user)
+  """
+  if not hasattr(socket, "AF_UNIX"):
+    return None
+  path = socket_path() if path is None else path
+  if not os.path.exists(path):
+    return None
+  if hasattr(os, "getuid") and os.stat(path).st_uid != os.getuid():
+    return None # not our daemon, convert in-process
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    sock.connect(path)
+  except OSError: # stale socket file
+    sock.close()
+    return None
+  return sock
+
+
+def request(header:dict, payload:bytes=b"", path:str=None):
+  """
+  Send a job to the daemon.
+  -> (reply header, reply payload) (None : no daemon is running)
+  """
+  sock = connect(path)
+  if sock is None:
+    return None
+  with sock:
+    sock.sendall(pack_message(header, payload))
+    header_length, payload_length = MESSAGE.unpack(recv_exactly(sock, MESSAGE.size))
+    reply = json.loads(recv_exactly(sock, header_length).decode("utf-8"))
+    return reply, recv_exactly(sock, payload_length)
+
+
+def forward(op:str, src:str, dest:str, path:str=None, **options) -> bool:
+  """
+  Convert src to dest on the daemon (paths are resolved here).
+  -> False if no daemon is running, raises RuntimeError if the job failed
+  """
+  header = dict(options, op=op, src=os.path.abspath(src), dest=os.path.abspath(dest))
+  for key in ["cache_dir", "szs"]:
+    if header.get(key) is not None:
+      header[key] = os.path.abspath(header[key])
+  result = request(header, path=path)
+  if result is None:
+    return False
+  if result[0].get("error") is not None:
+    raise RuntimeError(result[0]["error"])
+  return True
@@ -0,0 +1,208 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from cache import Cache, file_digest
+from client import MESSAGE, pack_message, request, socket_path
+from k2x import COLUMNS_EXPAND, cached_frames, iter_frames
+from schema import SHEETS
+from tables import iter_tables, write_excel, write_frames
+from x2k import excel_to_kmp, tables_to_kmp, write_output
+
+
+class LRU(object):
+  """
+  Thread-safe mapping of the max_items most recently used entries.
+  """
+  def __init__(self, max_items:int=16):
+    self.max_items = max_items
+    self.items = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key):
+    with self.lock:
+      if key not in self.items:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.items.move_to_end(key)
+      return self.items[key]
+
+  def put(self, key, value):
+    with self.lock:
+      self.items[key] = value
+      self.items.move_to_end(key)
+      while len(self.items) > self.max_items:
+        self.items.popitem(last=False)
+
+
+class Daemon(object):
+  """
+  Conversion server on a Unix socket.
+  Jobs run on a pool of jobs threads, at most 4*jobs are accepted at once (the others wait).
+  Parsed courses (k2x) and encoded KMPs (x2k) are kept in an LRU by content digest.
+
+  job header : {"op": "k2x" or "x2k", "src": path (None : payload), "dest": path (None : reply payload),
+                "format", "engine", "overwrite", "cache_dir", "cache_size", "szs", "szs_level", "validate"}
+  other ops : "ping", "stats", "shutdown"
+  """
+  def __init__(self, path:str=None, jobs:int=4, lru:int=16):
+    self.path = socket_path() if path is None else path
+    self.pool = ThreadPoolExecutor(max_workers=jobs)
+    self.limit = 4*jobs
+    self.lru = LRU(lru)
+    self.jobs = 0
+    self.started = time.time()
+
+  def frames(self, src, data:bytes=None, cache:Cache=None) -> list:
+    """
+    KMP -> [(sheet, DataFrame)] (shared, must not be modified)
+    cache : on-disk cache of the client, used for a src path missing from the LRU
+    """
+    if data is None:
+      with open(src, "rb") as f:
+        data = f.read()
+    key = ("k2x", hashlib.blake2b(data, digest_size=20).digest())
+    frames = self.lru.get(key)
+    if frames is None:
+      frames = list(iter_frames(data) if cache is None or src is None else cached_frames(src, cache))
+      self.lru.put(key, frames)
+    return frames
+
+  def kmp(self, src, data:bytes=None, fmt:str=None, engine:str=None, cache:Cache=None, validate:bool=True) -> bytes:
+    """
+    tables -> KMP bytes
+    """
+    if data is not None:
+      return excel_to_kmp(data, engine, cache, validate)
+    key = ("x2k", file_digest(src), fmt, engine, validate)
+    kmp = self.lru.get(key)
+    if kmp is None:
+      kmp = tables_to_kmp(iter_tables(src, list(SHEETS.keys()), fmt, engine), cache, validate)
+      self.lru.put(key, kmp)
+    return kmp
+
+  def run_job(self, header:dict, payload:bytes) -> tuple:
+    """
+    -> (reply header, reply payload)
+    """
+    op, src, dest = header["op"], header.get("src"), header.get("dest")
+    data = payload if src is None else None
+    if dest is not None and not header.get("overwrite", False) and os.path.exists(dest):
+      raise FileExistsError(dest + " arleady exists.")
+    cache = None
+    if header.get("cache_dir") is not None:
+      cache = Cache(header["cache_dir"], header.get("cache_size", 1024) << 20)
+
+    if op == "k2x":
+      fmt = header.get("format") or "xlsx"
+      frames = self.frames(src, data, cache)
+      if dest is None:
+        if fmt != "xlsx":
+          raise ValueError("Only xlsx can be returned inline.")
+        buf = BytesIO()
+        write_excel(frames, buf, COLUMNS_EXPAND)
+        return {}, buf.getvalue()
+      if fmt == "xlsx":
+        write_excel(frames, dest, COLUMNS_EXPAND)
+      else:
+        write_frames(frames, dest, fmt)
+      return {}, b""
+    if op == "x2k":
+      kmp = self.kmp(src, data, header.get("format"), header.get("engine"), cache, header.get("validate", True))
+      if dest is None:
+        return {}, kmp
+      write_output(dest, kmp, header.get("szs"), header.get("szs_level", 1))
+      return {}, b""
+    raise ValueError("Unknown op: " + str(op))
+
+  async def handle(self, reader, writer):
+    try:
+      header_length, payload_length = MESSAGE.unpack(await reader.readexactly(MESSAGE.size))
+      header = json.loads((await reader.readexactly(header_length)).decode("utf-8"))
+      payload = await reader.readexactly(payload_length)
+    except (asyncio.IncompleteReadError, ValueError):
+      writer.close()
+      return
+
+    reply, data = {}, b""
+    if header.get("op") == "ping":
+      pass
+    elif header.get("op") == "stats":
+      reply = {
+          "jobs": self.jobs, "uptime": time.time()-self.started, "lru_items": len(self.lru.items),
+          "lru_hits": self.lru.hits, "lru_misses": self.lru.misses}
+    elif header.get("op") == "shutdown":
+      self.server.close()
+    else:
+      start = time.perf_counter()
+      async with self.semaphore:
+        try:
+          reply, data = await asyncio.get_running_loop().run_in_executor(self.pool, self.run_job, header, payload)
+        except Exception as e:
+          reply = {"error": type(e).__name__ + ": " + str(e)}
+      self.jobs += 1
+      reply["seconds"] = time.perf_counter()-start
+    writer.write(pack_message(reply, data))
+    try:
+      await writer.drain()
+    finally:
+      writer.close()
+
+  async def serve(self):
+    self.semaphore = asyncio.Semaphore(self.limit)
+    # the socket is created 0600 (not chmodded after bind, other users could connect in between)
+    umask = os.umask(0o077)
+    try:
+      self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+    finally:
+      os.umask(umask)
+    try:
+      async with self.server:
+        await self.server.wait_closed()
+    finally:
+      self.pool.shutdown()
+      if os.path.exists(self.path):
+        os.remove(self.path)
+
+  def run(self):
+    if os.path.exists(self.path):
+      if request({"op": "ping"}, path=self.path) is not None:
+        raise FileExistsError(self.path + " : a daemon is already running.")
+      os.remove(self.path) # stale socket
+    try:
+      asyncio.run(self.serve())
+    except KeyboardInterrupt:
+      pass
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--socket', default=None, help=f'Unix socket path (default: $K2X_SOCKET or {socket_path()})')
+  parser.add_argument('-j', '--jobs', type=int, default=4, help='Worker threads')
+  parser.add_argument('--lru', type=int, default=16, help='Parsed courses kept in memory')
+  parser.add_argument('--stop', action='store_true', help='Stop the running daemon')
+  parser.add_argument('--stats', action='store_true', help='Print the statistics of the running daemon')
+
+  arg = parser.parse_args()
+  if arg.stop or arg.stats:
+    result = request({"op": "shutdown" if arg.stop else "stats"}, path=arg.socket)
+    if result is None:
+      sys.exit("No daemon is running.")
+    if arg.stats:
+      print(json.dumps(result[0], indent=2))
+    sys.exit(0)
+
+  daemon = Daemon(arg.socket, arg.jobs, arg.lru)
+  print(f"listening on {daemon.path}")
+  daemon.run()
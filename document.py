@@ -0,0 +1,167 @@
+import argparse
+import os
+
+import profiling
+from binfunc import MappedParser
+from cache import table_digest
+from k2x import read_section, section_to_frame
+from kmpdiff import read_kmp
+from schema import PATH_SHEETS, SHEETS
+from szs import is_archive
+from tables import frame_to_table
+from validate import check_tables
+from x2k import encode_sheet, section_name, splice_kmp, write_output
+
+
+class KmpDocument(object):
+  """
+  Editable KMP : the sections are kept as bytes, a sheet is decoded to a DataFrame on first access
+  and only the modified sheets are encoded again, the other sections are copied as they are.
+
+  doc = KmpDocument("course.szs")
+  doc["GOBJ"].loc[3, "Pos y"] += 100
+  doc["STGI"].loc[0, "Speed Factor"] = 1.2
+  doc.save()
+  """
+  def __init__(self, source):
+    """
+    source : KMP or SZS (path or bytes)
+    """
+    self.source = source if isinstance(source, str) else None
+    self.data = read_kmp(source)
+    self.frames = {}
+    self.digests = {}
+    self.replaced = set()
+    self.index()
+
+  def index(self):
+    # {section name: (entry, option, address, end)} of self.data
+    with MappedParser(self.data) as parser:
+      self.sections = {name: (entry, option, address, end) for name, entry, option, address, end in parser.sections()}
+      self.version = parser.version
+
+  def section_names(self, sheet:str) -> list:
+    return list(PATH_SHEETS.get(sheet, [sheet]))
+
+  def keys(self) -> list:
+    """
+    -> [sheet name] of the sections in the KMP
+    """
+    return [sheet for sheet in SHEETS if all(x in self.sections for x in self.section_names(sheet))]
+
+  def __contains__(self, sheet:str) -> bool:
+    return sheet in self.keys()
+
+  def __iter__(self):
+    return iter(self.keys())
+
+  def __getitem__(self, sheet:str):
+    """
+    sheet -> DataFrame, decoded once (edit it in place or assign a new one)
+    """
+    if sheet not in self.frames:
+      if sheet not in self:
+        raise KeyError(sheet)
+      pts = None
+      with MappedParser(self.data) as parser:
+        for name in self.section_names(sheet):
+          entry, option, address, end = self.sections[name]
+          arr, routes = read_section(parser, name, entry, address, end)
+          if name != self.section_names(sheet)[-1]:
+            pts = arr
+        _, df = section_to_frame(name, entry, option, arr, routes, pts)
+      self.frames[sheet] = df
+      self.digests[sheet] = table_digest(frame_to_table(df))
+    return self.frames[sheet]
+
+  def __setitem__(self, sheet:str, df):
+    if sheet not in SHEETS:
+      raise KeyError(sheet)
+    self.frames[sheet] = df
+    self.replaced.add(sheet)
+
+  @property
+  def dirty(self) -> list:
+    """
+    -> [sheet name] assigned or edited since they were decoded (or saved)
+    """
+    return [
+        sheet for sheet, df in self.frames.items()
+        if sheet in self.replaced or table_digest(frame_to_table(df)) != self.digests[sheet]]
+
+  def to_bytes(self, validate:bool=True) -> bytes:
+    """
+    -> KMP with the dirty sheets encoded again
+    validate : check the dirty sheets first (cross references to sheets never decoded are not checked)
+    """
+    dirty = self.dirty
+    if len(dirty) == 0:
+      return self.data
+    tables = [(sheet, frame_to_table(self.frames[sheet])) for sheet in dirty]
+    if validate:
+      check_tables(tables)
+    replaced = {}
+    for sheet, table in tables:
+      with profiling.phase("encode", sheet):
+        for data in encode_sheet(sheet, table):
+          replaced[section_name(data)] = data
+    missing = [name for name in replaced if name not in self.sections]
+    if len(missing) > 0:
+      raise ValueError(", ".join(missing) + " not found.")
+    return splice_kmp(self.data, replaced)
+
+  def save(self, output:str=None, validate:bool=True, szs:str=None, level:int=1) -> bytes:
+    """
+    Write the KMP to output (default: source), .szs replaces course.kmp of szs (default: source if it is an archive).
+    The document is clean afterwards.
+    """
+    data = self.to_bytes(validate)
+    if output is None:
+      if self.source is None:
+        raise ValueError("No output path.")
+      output = self.source
+    if szs is None and self.source is not None and is_archive(self.source):
+      szs = self.source
+    write_output(output, data, szs, level)
+    self.commit(data)
+    return data
+
+  def commit(self, data:bytes):
+    # data becomes the saved KMP, the decoded frames are kept as they are
+    if data is not self.data:
+      self.data = data
+      self.index()
+    self.digests = {sheet: table_digest(frame_to_table(df)) for sheet, df in self.frames.items()}
+    self.replaced = set()
+
+
+def parse_value(text:str):
+  try:
+    return int(text, 0)
+  except ValueError:
+    return float(text)
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description='Set cells of a KMP without converting the other sections')
+  parser.add_argument('kmp', help='KMP (or SZS) path')
+  parser.add_argument('--set', nargs=4, action='append', required=True, metavar=('SHEET', 'ROW', 'COLUMN', 'VALUE'),
+      help='Set a cell (row : 0 based index of the sheet), may be repeated')
+  parser.add_argument('--output', default=None, help='Output path, .szs replaces course.kmp in the archive (default: kmp)')
+  parser.add_argument('--no-validate', action='store_false', dest='validate', help='Skip the checks of the edited sheets')
+  parser.add_argument('-o', '--overwrite', action='store_true', dest='o', help='If enabled, allows overwriting.')
+
+  arg = parser.parse_args()
+  output = arg.kmp if arg.output is None else arg.output
+  if not arg.o and os.path.exists(output):
+    raise FileExistsError(output + " arleady exists.")
+
+  doc = KmpDocument(arg.kmp)
+  for sheet, row, column, value in arg.set:
+    df = doc[sheet]
+    if column not in df.columns:
+      raise ValueError(f"{sheet}: column '{column}' not found.")
+    df.loc[int(row), column] = value if column == "Reference (hex)" else parse_value(value)
+  edited = doc.dirty
+  doc.save(output, arg.validate)
+  print(f"{arg.kmp} -> {output} ({', '.join(edited) or 'nothing'} encoded again)")
@@ -0,0 +1,200 @@
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+from batch import expand_paths
+from cache import file_digest
+from kmpfile import KmpFile
+from schema import CONVERTER_VERSION, SHEETS
+
+
+# meta : converter version of the index, courses : one row per indexed file, sections : header stats,
+# then one table per sheet (course, row, columns)
+META = "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+COURSES = """CREATE TABLE IF NOT EXISTS courses (
+    id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime REAL, size INTEGER, digest TEXT,
+    version INTEGER, indexed REAL)"""
+SECTIONS = """CREATE TABLE IF NOT EXISTS sections (
+    course INTEGER, section TEXT, entries INTEGER, points INTEGER, bytes INTEGER)"""
+
+
+def quote(name:str) -> str:
+  return '"' + name.replace('"', '""') + '"'
+
+
+def connect(path:str) -> sqlite3.Connection:
+  """
+  Open (or create) the index database.
+  An index written by another converter version (other sheet columns) is emptied, every file is indexed again.
+  """
+  db = sqlite3.connect(path)
+  db.execute(META)
+  row = db.execute("SELECT value FROM meta WHERE key = 'converter'").fetchone()
+  if row is None or row[0] != CONVERTER_VERSION:
+    for table in ["courses", "sections"] + list(SHEETS.keys()):
+      db.execute(f"DROP TABLE IF EXISTS {quote(table)}")
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('converter', ?)", (CONVERTER_VERSION,))
+  db.execute(COURSES)
+  db.execute(SECTIONS)
+  db.execute("CREATE INDEX IF NOT EXISTS sections_course ON sections (course)")
+  for sheet, columns in SHEETS.items():
+    clms = ", ".join(["course INTEGER", "row INTEGER"] + [quote(clm) for clm in columns])
+    db.execute(f"CREATE TABLE IF NOT EXISTS {quote(sheet)} ({clms})")
+    db.execute(f"CREATE INDEX IF NOT EXISTS {quote(sheet + '_course')} ON {quote(sheet)} (course)")
+  db.commit()
+  return db
+
+
+def course_rows(path:str) -> tuple:
+  """
+  KMP -> (version, [section stats], {sheet: [rows]}) (rows without the course key)
+  """
+  from k2x import iter_frames
+  with open(path, "rb") as f:
+    data = f.read()
+  with KmpFile(data) as kmp:
+    version, stats = kmp.version, kmp.stats()
+  tables = {}
+  for sheet, df in iter_frames(data):
+    columns = [[None if x != x else x for x in df[clm].tolist()] for clm in SHEETS[sheet]]
+    tables[sheet] = [(i,) + row for i, row in enumerate(zip(*columns))]
+  return version, stats, tables
+
+
+def parse_file(path:str) -> tuple:
+  """
+  -> (path, course_rows() or None, error or None)
+  """
+  try:
+    return path, course_rows(path), None
+  except Exception as e:
+    return path, None, type(e).__name__ + ": " + str(e)
+
+
+def stale_paths(db:sqlite3.Connection, paths:list) -> dict:
+  """
+  -> {path to parse: digest} (new, or changed mtime/size and content)
+  Files with a new mtime but the same digest are only touched.
+  """
+  result = {}
+  for path in paths:
+    stat = os.stat(path)
+    row = db.execute("SELECT mtime, size, digest FROM courses WHERE path = ?", (path,)).fetchone()
+    if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+      continue
+    digest = file_digest(path).hex()
+    if row is not None and row[2] == digest:
+      db.execute("UPDATE courses SET mtime = ?, size = ? WHERE path = ?", (stat.st_mtime, stat.st_size, path))
+      continue
+    result[path] = digest
+  db.commit()
+  return result
+
+
+def delete_course(db:sqlite3.Connection, course:int):
+  for table in ["sections"] + list(SHEETS.keys()):
+    db.execute(f"DELETE FROM {quote(table)} WHERE course = ?", (course,))
+  db.execute("DELETE FROM courses WHERE id = ?", (course,))
+
+
+def store(db:sqlite3.Connection, path:str, digest:str, rows:tuple):
+  version, stats, tables = rows
+  stat = os.stat(path)
+  row = db.execute("SELECT id FROM courses WHERE path = ?", (path,)).fetchone()
+  if row is not None:
+    delete_course(db, row[0])
+  course = db.execute(
+      "INSERT INTO courses (path, mtime, size, digest, version, indexed) VALUES (?, ?, ?, ?, ?, ?)",
+      (path, stat.st_mtime, stat.st_size, digest, version, time.time())).lastrowid
+  db.executemany("INSERT INTO sections VALUES (?, ?, ?, ?, ?)", [(course,) + x for x in stats])
+  for sheet, data in tables.items():
+    marks = ", ".join(["?"] * (len(SHEETS[sheet]) + 2))
+    db.executemany(f"INSERT INTO {quote(sheet)} VALUES ({marks})", [(course,) + x for x in data])
+  db.commit()
+
+
+def prune(db:sqlite3.Connection) -> int:
+  """
+  Remove the courses whose file no longer exists.
+  """
+  missing = [x for x in db.execute("SELECT id, path FROM courses").fetchall() if not os.path.exists(x[1])]
+  for course, path in missing:
+    delete_course(db, course)
+  db.commit()
+  return len(missing)
+
+
+def build_index(db_path:str, paths:list, jobs:int=1, remove_missing:bool=False) -> tuple:
+  """
+  Index (or reindex the changed) KMPs.
+  -> (indexed, unchanged, removed, [(path, error)])
+  """
+  db = connect(db_path)
+  try:
+    paths = [os.path.abspath(path) for path in paths]
+    todo = stale_paths(db, paths)
+    if jobs <= 1:
+      results = map(parse_file, list(todo))
+    else:
+      from concurrent.futures import ProcessPoolExecutor
+      pool = ProcessPoolExecutor(max_workers=jobs)
+      results = pool.map(parse_file, list(todo))
+    errors = []
+    for path, rows, error in results:
+      if error is None:
+        store(db, path, todo[path], rows)
+      else:
+        errors.append((path, error))
+    if jobs > 1:
+      pool.shutdown()
+    removed = prune(db) if remove_missing else 0
+  finally:
+    db.close()
+  return len(todo)-len(errors), len(paths)-len(todo), removed, errors
+
+
+def query(db_path:str, sql:str, params:tuple=()) -> tuple:
+  """
+  -> (column names, rows)
+  """
+  db = sqlite3.connect(db_path)
+  try:
+    cursor = db.execute(sql, params)
+    return [x[0] for x in cursor.description or []], cursor.fetchall()
+  finally:
+    db.close()
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--db', required=True, help='SQLite index path')
+  parser.add_argument('--kmp', default=None, help='KMP (or SZS) path, directory or glob to index')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes for parsing')
+  parser.add_argument('--prune', action='store_true', help='Remove indexed courses whose file no longer exists')
+  parser.add_argument('--query', default=None,
+      help='SQL to run, tables are courses, sections and one per sheet ("GOBJ", "CKPT+CKPH", ...)')
+
+  arg = parser.parse_args()
+  if arg.kmp is None and arg.query is None and not arg.prune:
+    parser.error("--kmp, --query or --prune is required.")
+
+  if arg.kmp is not None or arg.prune:
+    start = time.perf_counter()
+    paths = [] if arg.kmp is None else sorted(set(expand_paths(arg.kmp, ".kmp") + expand_paths(arg.kmp, ".szs")))
+    indexed, unchanged, removed, errors = build_index(arg.db, paths, arg.jobs, arg.prune)
+    print(f"{indexed} indexed, {unchanged} unchanged, {removed} removed, {len(errors)} failed "
+          f"({time.perf_counter()-start:.2f}s)")
+    for path, error in errors:
+      print(f"  {path} : {error}")
+
+  if arg.query is not None:
+    start = time.perf_counter()
+    columns, rows = query(arg.db, arg.query)
+    print("\t".join(columns))
+    for row in rows:
+      print("\t".join(["" if x is None else str(x) for x in row]))
+    print(f"{len(rows)} rows ({time.perf_counter()-start:.3f}s)", file=sys.stderr)
+
+  sys.exit(int(arg.kmp is not None and len(errors) > 0))
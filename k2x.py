@@ -1,226 +1,230 @@
 import argparse
 import os
-
-import numpy as np
-import pandas as pd
-
-from binfunc import BinaryParser
-
-
-def pt_ph_parse(parser:BinaryParser, entry:int, pts:list, sect:str) -> list:
-  if len(pts) == 0:
+import sys
+from collections import OrderedDict
+from io import BytesIO
+
+import profiling
+from batch import expand_paths, is_batch, output_path, run_batch
+from binfunc import decode_xpf, native_columns, open_kmp
+from cache import Cache, file_digest
+from client import forward
+from kmpfile import print_stats
+from schema import PATH_SHEETS, POTI_ROUTE, RECORDS, SHEETS
+from tables import FORMATS, write_excel, write_frames
+
+
+def section_frame(arr, columns:list, extra:dict={}):
+  import pandas as pd
+  data = native_columns(arr)
+  data.update(extra)
+  return pd.DataFrame({clm: data[clm] for clm in columns}, columns=columns)
+
+
+def pt_ph_frame(pts, paths, columns:list, sect:str):
+  import numpy as np
+  import pandas as pd
+  if pts is None:
     raise ValueError(sect[:-1] + "T" + " not found.")
-  out = []
-  for i in range(entry):
-    start = parser.read_byte
-    length = parser.read_byte
-    append_data = parser.read_byte_s(12)
-    if sect == "ENPH":
-      append_data += parser.read_byte_s(2)
+  starts = paths["_start"].astype(np.int64)
+  lengths = paths["_length"].astype(np.int64)
+  firsts = np.cumsum(lengths) - lengths
+  total = int(lengths.sum())
+  # point order follows the path groups
+  order = np.repeat(starts - firsts, lengths) + np.arange(total)
+  if total > 0 and order.max() >= len(pts):
+    raise ValueError(sect + " refers to a missing point.")
+
+  data = {k: v[order] for k, v in native_columns(pts).items()}
+  used = lengths > 0
+  group = dict(native_columns(paths[used]), **{sect + " ID": np.arange(len(paths))[used]})
+  for clm, values in group.items():
+    if clm.startswith("_"):
+      continue
+    data[clm] = np.full(total, np.nan)
+    data[clm][firsts[used]] = values
+  return pd.DataFrame({clm: data[clm] for clm in columns}, columns=columns)
+
+
+def read_section(parser, section_name:str, entry:int, address:int, end:int) -> tuple:
+  """
+  -> (structured array of the entries, POTI route headers or None)
+  """
+  with profiling.phase("parse", section_name):
+    if section_name == "POTI":
+      routes, arr = parser.read_routes(entry, address, end)
+      return arr, routes
+    if section_name in RECORDS:
+      return parser.read_entries(RECORDS[section_name], entry, address, end), None
+    raise ValueError("Invalid header name.")
+
+
+def section_to_frame(section_name:str, entry:int, option:int, arr, routes=None, pts=None) -> tuple:
+  """
+  decoded section -> (sheet name, DataFrame)
+  routes : POTI route headers, pts : points of a path section (ENPH, ITPH, CKPH)
+  """
+  import numpy as np
+  columns = SHEETS
+  path_sheets = {ph: sheet for sheet, (pt, ph) in PATH_SHEETS.items()}
+  with profiling.phase("dataframe", section_name):
+    if section_name == "POTI":
+      lengths = routes["_points"].astype(np.int64)
+      firsts = (np.cumsum(lengths) - lengths)[lengths > 0]
+      extra = {"ID": np.arange(entry)[lengths > 0]}
+      for clm in POTI_ROUTE.columns:
+        extra[clm] = routes[clm][lengths > 0]
+      for clm in extra:
+        values = np.full(len(arr), np.nan)
+        values[firsts] = extra[clm]
+        extra[clm] = values
+      df = section_frame(arr, columns[section_name], extra)
+    elif section_name in path_sheets:
+      sheet = path_sheets[section_name]
+      df = pt_ph_frame(pts, arr, columns[sheet], section_name)
+      section_name = sheet
+    elif section_name == "GOBJ":
+      extra = decode_xpf(arr["_objects"], arr["_presence"])
+      extra["Reference (hex)"] = [hex(x) for x in arr["_reference"].tolist()]
+      df = section_frame(arr, columns[section_name], extra)
+    elif section_name == "CAME":
+      came_st1, came_st2 = divmod(option, 256)
+      idx = np.arange(entry)
+      extra = {
+          "First1": np.where(idx==came_st1, 1, np.nan),
+          "First2": np.where(idx==came_st2, 1, np.nan)}
+      df = section_frame(arr, columns[section_name], extra)
+    elif section_name == "STGI":
+      speed = (arr["_speed"].astype(np.uint32) << 16).view(np.float32)
+      df = section_frame(arr, columns[section_name], {"Speed Factor": speed})
     else:
-      parser.read_uint16 # padding
-    for j in range(start, start+length):
-      if j == start:
-        pts[j] += [i] + append_data
-      else:
-        pts[j] += [np.nan]*(len(append_data)+1)
-      out.append(pts[j])
-  return out
-
-
-def kmp_dump(path, dest):
-  # Excel columns 1
-  columns = {
-      "KTPT" : [
-        "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z", "PlayerIdx"],
-      "ENPT+ENPH" : [
-        "Pos x", "Pos y", "Pos z", "Range", "Setting1", "Setting2", "Setting3",\
-        "ENPH ID", "Last 1", "Last 2", "Last 3", "Last 4", "Last 5", "Last 6",\
-        "Next 1", "Next 2", "Next 3", "Next 4", "Next 5", "Next 6", "Dispatch1", "Dispatch2"],
-      "ITPT+ITPH" : [
-        "Pos x", "Pos y", "Pos z", "Range", "Setting1", "Setting2",\
-        "ITPH ID", "Last 1", "Last 2", "Last 3", "Last 4", "Last 5", "Last 6",\
-        "Next 1", "Next 2", "Next 3", "Next 4", "Next 5", "Next 6"],
-      "CKPT+CKPH" : [
-        "Left x", "Left y", "Right x", "Right y", "Respawn", "Type",\
-        "CKPH ID", "Last 1", "Last 2", "Last 3", "Last 4", "Last 5", "Last 6",\
-        "Next 1", "Next 2", "Next 3", "Next 4", "Next 5", "Next 6"],
-      "GOBJ" : [
-        "Type(LE)", "Enable(LE)", "Object", "Reference (hex)",\
-        "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z",\
-        "Scale x", "Scale y", "Scale z", "Route",\
-        "Setting1", "Setting2", "Setting3", "Setting4", "Setting5", "Setting6", "Setting7", "Setting8",\
-        "MODE", "Parameters", "Multi(>2)", "Multi(<3)", "Single"],
-      "POTI" : [
-        "ID", "PointSetting 1", " PointSetting 2", "Pos x", "Pos y", "Pos z", "Setting1", "Setting2"],
-      "AREA" : [
-        "Shape", "Type", "Camera", "Priority", "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z",\
-        "Scale x", "Scale y", "Scale z", "Setting 1", "Setting 2", "Route", "Enemy"],
-      "CAME" : [
-        "Type", "First1", "First2", "Next", "Route", "Camera velocity", "Zoom velocity", "View velocity",\
-        "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z", "ZoomStart", "ZoomEnd",\
-        "Start pos x", "Start pos y", "Start pos z", "End pos x", "End pos y", "End pos z", "Time"],
-      "JGPT" : [
-        "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z", "Range"],
-      "CNPT" : [
-        "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z", "Cannon ID", "Shoot"],
-      "MSPT" : [
-        "Pos x", "Pos y", "Pos z", "Rot x", "Rot y", "Rot z", "Entry"],
-      "STGI" : [
-        "Lap", "Pole", "Distance", "Flare", "Flare R", "Flare G", "Flare B", "Flare A", "Speed Factor"]
-      }
-  # Excel columns 2 (modify width)
-  columns_expand = [
-      None, ["V", "W"], None, None, ["C", "E", "Y"],
-      ["C","D"], None, ["G", "H", "I", "P", "Q", "R", "S", "T", "U", "V", "W"], 
-      None, "H", None, "J"]
-  function_paths = ["ENPH", "ITPH", "CKPH"]
-  match_sect = list(columns.keys())[1:4]
-  pd_dfs = []
-  pts = []
-  section_data = []
-
-  with open(path, "rb") as f:
-    parser = BinaryParser(f)
-    magic = parser.read_string
-    if magic != "RKMD":
-      raise ValueError("Invalid file.")
-
-    file_length = parser.read_uint32
-    sections = parser.read_uint16
-    header_length = parser.read_uint16
-    version = parser.read_uint32
-    offsets = parser.read_uint32_s(sections)
-
-    for head in offsets:
-      parser.seek(head + header_length)
-      section_name = parser.read_string
-      entry = parser.read_uint16
-      if section_name == "CAME":
-        came_st1 = parser.read_byte
-        came_st2 = parser.read_byte
-      else:
-        parser.read_uint16 # padding
-
-      data = []
-      if section_name in function_paths:
-        data = pt_ph_parse(parser, entry, pts, section_name)
-        section_name = match_sect[function_paths.index(section_name)]
-        pts.clear()
-      elif section_name == "STGI":
-        opt = parser.read_byte_s(4)
-        parser.read_byte # padding
-        flarecolor = parser.read_byte_s(4)
-        padding = parser.read_byte
-        speed = parser.read_float_half
-        data.append(opt + flarecolor + [speed])
-      else:
-        for i in range(entry):
-          if section_name == "KTPT":
-            pos_rots = parser.read_float_s(6)
-            index = parser.read_int16
-            parser.read_uint16 # padding
-            data.append(pos_rots + [index])
-          elif section_name == "ENPT" or section_name == "ITPT":
-            pos = parser.read_float_s(4)
-            set1 = parser.read_uint16
-            appends = pos + [set1]
-            if section_name == "ENPT":
-              appends += parser.read_byte_s(2)
-            else:
-              appends += [parser.read_uint16]
-            pts.append(appends)
-          elif section_name == "CKPT":
-            pos = parser.read_float_s(4)
-            opt = parser.read_byte_s(2)
-            parser.read_byte_s(2) # not padding (prev, next), but ignore
-            pts.append(pos + opt)
-          elif section_name == "GOBJ":
-            xpf_obj = parser.read_objects
-            xpf_ref = parser.read_reference
-            vec = parser.read_float_s(9)
-            route = parser.read_uint16
-            setting = parser.read_uint16_s(8)
-            xpf_flag = parser.read_presence
-            data.append(xpf_obj + [xpf_ref] + vec + [route] + setting + xpf_flag)
-          elif section_name == "POTI":
-            idx = i
-            num_pos = parser.read_uint16
-            _sets = parser.read_byte_s(2)
-            for j in range(num_pos):
-              pos = parser.read_float_s(3)
-              _sets2 = parser.read_uint16_s(2)
-              if j != 0:
-                idx = np.nan
-                _sets = [np.nan]*2
-              data.append([idx] + _sets + pos + _sets2)
-          elif section_name == "AREA":
-            opt_1 = parser.read_byte_s(4)
-            vec = parser.read_float_s(9)
-            sets = parser.read_uint16_s(2)
-            opt_2 = parser.read_byte_s(2)
-            parser.read_uint16 # padding
-            data.append(opt_1 + vec + sets + opt_2)
-          elif section_name == "CAME":
-            came_type = parser.read_byte
-            next_idx = parser.read_byte
-            parser.read_byte # padding
-            route = parser.read_byte
-            opt_1 = parser.read_uint16_s(3)
-            parser.read_byte_s(2) # padding
-            vec = parser.read_float_s(15)
-            f1 = 1 if i==came_st1 else np.nan
-            f2 = 1 if i==came_st2 else np.nan
-            data.append([came_type, f1, f2, next_idx, route] + opt_1 + vec)
-          elif section_name == "JGPT":
-            pos_rots = parser.read_float_s(6)
-            parser.read_uint16 # padding
-            ranges = parser.read_int16
-            data.append(pos_rots + [ranges])
-          elif section_name == "CNPT":
-            pos_rots = parser.read_float_s(6)
-            opt = parser.read_uint16_s(2)
-            data.append(pos_rots + opt)
-          elif section_name == "MSPT":
-            pos_rots = parser.read_float_s(6)
-            idx = parser.read_uint16
-            parser.read_uint16 # padding
-            data.append(pos_rots + [idx])
-          else:
-            raise ValueError("Invalid header name.")
-      if len(data) == 0 and len(pts) > 0: continue
-      df = pd.DataFrame(data, columns=columns[section_name])
-      pd_dfs.append(df)
-      section_data.append(section_name)
-    
-  with pd.ExcelWriter(output) as writer:
-    for i in range(len(pd_dfs)):
-      pd_dfs[i].to_excel(writer, sheet_name=section_data[i], engine="openpyxl")
-      if columns_expand[i] is not None:
-        worksheet = writer.book[section_data[i]]
-        if isinstance(columns_expand[i], str):
-          worksheet.column_dimensions[columns_expand[i]].width = 15
-        elif isinstance(columns_expand[i], list):
-          for clms in columns_expand[i]:
-            worksheet.column_dimensions[clms].width = 15
+      df = section_frame(arr, columns[section_name])
+  return section_name, df
+
+
+def iter_frames(source):
+  """
+  KMP (path, bytes or binary file-like object) -> yield (sheet name, DataFrame) in section order
+  """
+  match_sect_pts = [pt for pt, ph in PATH_SHEETS.values()]
+  match_sect_phs = [ph for pt, ph in PATH_SHEETS.values()]
+  pts = None
+
+  with open_kmp(source) as parser:
+    for section_name, entry, option, address, end in parser.sections():
+      arr, routes = read_section(parser, section_name, entry, address, end)
+      if section_name in match_sect_pts:
+        pts = arr
+        continue
+      yield section_to_frame(section_name, entry, option, arr, routes, pts)
+      if section_name in match_sect_phs:
+        pts = None
+
+
+def cached_frames(path, cache:Cache=None):
+  """
+  iter_frames, reusing the decoded frames of an already seen KMP
+  """
+  if cache is None or not isinstance(path, str):
+    yield from iter_frames(path)
+    return
+  key = cache.key("k2x", file_digest(path))
+  with profiling.phase("cache"):
+    frames = cache.get_object(key)
+  if frames is None:
+    frames = list(iter_frames(path))
+    cache.put_object(key, frames)
+  yield from frames
+
+
+# Excel columns (modify width)
+COLUMNS_EXPAND = {
+    "ENPT+ENPH" : ["V", "W"],
+    "GOBJ" : ["C", "E", "Y"],
+    "POTI" : ["C","D"],
+    "CAME" : ["G", "H", "I", "P", "Q", "R", "S", "T", "U", "V", "W"],
+    "CNPT" : "H",
+    "STGI" : "J"}
+
+
+def kmp_to_tables(source) -> OrderedDict:
+  """
+  KMP (path, bytes or binary file-like object) -> {sheet name: DataFrame}
+  """
+  return OrderedDict(iter_frames(source))
+
+
+def kmp_to_xlsx_bytes(source) -> bytes:
+  """
+  KMP (path, bytes or binary file-like object) -> xlsx bytes
+  """
+  buf = BytesIO()
+  write_excel(iter_frames(source), buf, COLUMNS_EXPAND)
+  return buf.getvalue()
+
+
+def kmp_dump(path, dest, fmt="xlsx", cache:Cache=None):
+  if fmt != "xlsx":
+    write_frames(cached_frames(path, cache), dest, fmt)
+  else:
+    write_excel(cached_frames(path, cache), dest, COLUMNS_EXPAND)
 
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
-  parser.add_argument('--kmp', required=True, help='KMP path')
-  parser.add_argument('--excel', default=None, help='Dumped xlsx path')
+  parser.add_argument('--kmp', required=True, help='KMP path, directory or glob')
+  parser.add_argument('--excel', default=None, help='Dumped xlsx path (output directory for batch)')
+  parser.add_argument('-f', '--format', default='xlsx', choices=FORMATS,
+      help='Output format, other than xlsx is a directory of one file per sheet')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes for batch')
+  parser.add_argument('--cache-dir', default=None, help='Conversion cache directory (disabled if not given)')
+  parser.add_argument('--cache-size', type=int, default=1024, help='Cache size limit (MB)')
+  parser.add_argument('--profile', nargs='?', const='-', default=None,
+      help='Write a JSON profile (time, I/O, peak memory per section and phase) to this path (default: stdout)')
+  parser.add_argument('--cprofile', default=None, help='Write cProfile stats to this path')
+  parser.add_argument('--stats', action='store_true',
+      help='Print section names, entry counts and sizes from the headers (nothing is converted)')
+  parser.add_argument('--verify', action='store_true',
+      help='Convert KMP -> tables -> KMP in memory and compare with the original (nothing is written)')
+  parser.add_argument('--verify-excel', action='store_true', help='Verify through xlsx bytes instead of tables')
+  parser.add_argument('--rtol', type=float, default=0.0, help='Relative float tolerance of --verify')
+  parser.add_argument('--atol', type=float, default=0.0, help='Absolute float tolerance of --verify')
+  parser.add_argument('--no-daemon', action='store_true',
+      help='Convert in this process even if a daemon (daemon.py) is running')
   parser.add_argument('-o', '--overwrite', action='store_true', dest='o', 
       help='If enabled, allows overwriting.')
 
   arg = parser.parse_args()
+  if arg.stats:
+    for path in expand_paths(arg.kmp, ".kmp"):
+      print_stats(path)
+    sys.exit(0)
+  if arg.verify or arg.verify_excel:
+    from verify import verify_files
+    failed = verify_files(expand_paths(arg.kmp, ".kmp"), arg.jobs, arg.rtol, arg.atol, arg.verify_excel)
+    sys.exit(int(failed > 0))
+
+  cache = None if arg.cache_dir is None else Cache(arg.cache_dir, arg.cache_size << 20)
+  profiled = {"report": arg.profile, "cprofile": arg.cprofile}
+  if arg.jobs > 1 and (arg.profile is not None or arg.cprofile is not None):
+    parser.error("--profile and --cprofile need --jobs 1.")
+
+  if is_batch(arg.kmp):
+    if arg.excel is not None:
+      os.makedirs(arg.excel, exist_ok=True)
+    pairs = [(src, output_path(src, arg.excel, "", "." + arg.format)) for src in expand_paths(arg.kmp, ".kmp")]
+    results = profiling.run(run_batch, kmp_dump, pairs, arg.jobs, arg.o, (arg.format, cache), **profiled)
+    sys.exit(int(any(x[2] is not None for x in results)))
 
   if arg.excel is None:
-    output = arg.kmp + '.xlsx'
+    output = arg.kmp + '.' + arg.format
   else:
     output = arg.excel
 
   if not arg.o and os.path.exists(output):
     raise FileExistsError(output + " arleady exists.")
 
-  kmp_dump(arg.kmp, output)
+  options = {"format": arg.format, "overwrite": arg.o, "cache_dir": arg.cache_dir, "cache_size": arg.cache_size}
+  if arg.no_daemon or arg.profile is not None or arg.cprofile is not None or not forward("k2x", arg.kmp, output, **options):
+    profiling.run(kmp_dump, arg.kmp, output, arg.format, cache, **profiled)
   print(f"{arg.kmp} -> {output}")
@@ -0,0 +1,281 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import sys
+from difflib import SequenceMatcher
+from struct import Struct, pack, unpack
+
+from binfunc import MappedParser
+from schema import POTI_ROUTE, RECORDS, SECTION_HEADER
+from szs import is_archive, szs_kmp
+
+
+# Patch : {"format": PATCH_FORMAT, "base": digest, "result": digest, "version": file version (if changed),
+#          "order": [section names] (if changed), "sections": [section patch]}
+# section patch : {"section", "option" (if changed), "changed": [{"entry": base index, "fields": {field: value}}],
+#                  "removed": [base indexes], "inserted": [{"entry": result index, "fields": {field: value}}],
+#                  "tail": hex of the bytes after the entries (if changed)}
+# Unknown sections are replaced as a whole : {"section", "option", "entry", "data": hex}.
+# POTI entries are routes, the fields of point j are "<field>[j]".
+# Floats are numbers (non-finite floats : "0x" + hex of their bits), every value is bit exact.
+PATCH_FORMAT = "k2x-kmp-patch-1"
+
+
+def digest(data) -> str:
+  return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def read_kmp(source) -> bytes:
+  """
+  KMP or SZS (path or bytes) -> KMP bytes
+  """
+  if is_archive(source):
+    return szs_kmp(source)
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    return bytes(source)
+  with open(source, "rb") as f:
+    return f.read()
+
+
+def entry_layout(name:str, data:bytes=None) -> list:
+  """
+  -> [(field, struct format)] of one entry (POTI : route header + its points)
+  """
+  if name != "POTI":
+    return RECORDS[name].fields
+  points = POTI_ROUTE.offsets["_points"][0].unpack_from(data)[0]
+  return POTI_ROUTE.fields + [(f"{key}[{j}]", fmt) for j in range(points) for key, fmt in RECORDS["POTI"].fields]
+
+
+def split_entries(name:str, entry:int, data:bytes) -> tuple:
+  """
+  section body -> ([entry bytes], bytes after the entries)
+  """
+  entries, address = [], 0
+  for i in range(entry):
+    size = RECORDS[name].size
+    if name == "POTI":
+      size = POTI_ROUTE.size + POTI_ROUTE.offsets["_points"][0].unpack_from(data, address)[0]*RECORDS["POTI"].size
+    if address + size > len(data):
+      raise ValueError(name + " exceeds its section.")
+    entries.append(data[address:address+size])
+    address += size
+  return entries, data[address:]
+
+
+def entry_fields(name:str, data:bytes) -> list:
+  """
+  entry bytes -> [(field, struct format, field bytes)]
+  """
+  fields, offset = [], 0
+  for key, fmt in entry_layout(name, data):
+    size = Struct(">" + fmt).size
+    fields.append((key, fmt, data[offset:offset+size]))
+    offset += size
+  return fields
+
+
+def unpack_entry(name:str, data:bytes) -> dict:
+  """
+  entry bytes -> {field: value} (non-finite floats : "0x" + hex of their bits)
+  """
+  result = {}
+  for key, fmt, raw in entry_fields(name, data):
+    value = unpack(">" + fmt, raw)[0]
+    result[key] = "0x" + raw.hex() if fmt == "f" and not math.isfinite(value) else value
+  return result
+
+
+def pack_value(fmt:str, value) -> bytes:
+  if fmt == "f" and isinstance(value, str):
+    return pack(">I", int(value, 16))
+  return pack(">" + fmt, value)
+
+
+def pack_entry(name:str, fields:dict) -> bytes:
+  """
+  {field: value} -> entry bytes (POTI : fields of points past "_points" are ignored)
+  """
+  try:
+    layout = entry_layout(name, POTI_ROUTE.struct.pack(*[fields[key] for key, _ in POTI_ROUTE.fields])
+                          if name == "POTI" else None)
+    return b"".join([pack_value(fmt, fields[key]) for key, fmt in layout])
+  except KeyError as e:
+    raise ValueError(f"{name}: field {e} not found.") from None
+
+
+def changed_fields(name:str, a:bytes, b:bytes) -> dict:
+  """
+  entry bytes, entry bytes -> {field: new value} of the fields whose bytes differ
+  """
+  old = {key: raw for key, fmt, raw in entry_fields(name, a)}
+  new = unpack_entry(name, b)
+  return {key: new[key] for key, fmt, raw in entry_fields(name, b) if old.get(key) != raw}
+
+
+def diff_section(name:str, base:tuple, result:tuple) -> dict:
+  """
+  (entry, option, body) of the base and result section (base None : new section) -> section patch or None
+  """
+  entry, option, data = result
+  if name not in RECORDS:
+    if base is not None and base == result:
+      return None
+    return {"section": name, "option": option, "entry": entry, "data": data.hex()}
+  a, a_tail = split_entries(name, base[0], base[2]) if base is not None else ([], b"")
+  b, b_tail = split_entries(name, entry, data)
+  patch = {"section": name}
+  if base is None or base[1] != option:
+    patch["option"] = option
+  changed, removed, inserted = [], [], []
+  for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b, autojunk=False).get_opcodes():
+    if tag == "equal":
+      continue
+    pairs = min(i2-i1, j2-j1)
+    for k in range(pairs):
+      changed.append({"entry": i1+k, "fields": changed_fields(name, a[i1+k], b[j1+k])})
+    removed += range(i1+pairs, i2)
+    inserted += [{"entry": j, "fields": unpack_entry(name, b[j])} for j in range(j1+pairs, j2)]
+  for key, values in [("changed", changed), ("removed", removed), ("inserted", inserted)]:
+    if len(values) > 0:
+      patch[key] = values
+  if a_tail != b_tail:
+    patch["tail"] = b_tail.hex()
+  return patch if len(patch) > 1 else None
+
+
+def kmp_sections(data:bytes) -> tuple:
+  """
+  KMP bytes -> ({section name: (entry, option, body)} in file order, file version)
+  """
+  with MappedParser(data) as parser:
+    sections = {
+        name: (entry, option, bytes(parser.buffer[address:end]))
+        for name, entry, option, address, end in parser.sections()}
+    return sections, parser.version
+
+
+def diff_kmp(base, result) -> dict:
+  """
+  KMP, KMP (path or bytes, SZS too) -> patch turning base into result
+  """
+  base, result = read_kmp(base), read_kmp(result)
+  a, a_version = kmp_sections(base)
+  b, b_version = kmp_sections(result)
+  patch = {"format": PATCH_FORMAT, "base": digest(base), "result": digest(result)}
+  if a_version != b_version:
+    patch["version"] = b_version
+  if list(a.keys()) != list(b.keys()):
+    patch["order"] = list(b.keys())
+  patch["sections"] = [x for x in [diff_section(name, a.get(name), b[name]) for name in b] if x is not None]
+  return patch
+
+
+def patch_section(name:str, base:tuple, patch:dict) -> bytes:
+  """
+  (entry, option, body) or None, section patch -> section bytes (header included)
+  """
+  if "data" in patch:
+    data = bytes.fromhex(patch["data"])
+    return SECTION_HEADER.pack(name.encode("utf-8"), patch["entry"], patch["option"]) + data
+  entry, option, data = base if base is not None else (0, 0, b"")
+  entries, tail = split_entries(name, entry, data)
+  entries = [unpack_entry(name, x) for x in entries]
+  for change in patch.get("changed", []):
+    entries[change["entry"]].update(change["fields"])
+  removed = set(patch.get("removed", []))
+  entries = [x for i, x in enumerate(entries) if i not in removed]
+  for insert in sorted(patch.get("inserted", []), key=lambda x: x["entry"]):
+    entries.insert(insert["entry"], insert["fields"])
+  if "tail" in patch:
+    tail = bytes.fromhex(patch["tail"])
+  body = b"".join([pack_entry(name, x) for x in entries]) + tail
+  return SECTION_HEADER.pack(name.encode("utf-8"), len(entries), patch.get("option", option)) + body
+
+
+def apply_patch(base, patch:dict, check:bool=True) -> bytes:
+  """
+  KMP (path or bytes, SZS too), patch -> patched KMP bytes
+  Only the patched sections are rebuilt, the offset table and the file length are computed again.
+  check : the base and the result must have the digests recorded in the patch
+  """
+  from x2k import build_kmp
+  if patch.get("format") != PATCH_FORMAT:
+    raise ValueError("Not a KMP patch.")
+  base = read_kmp(base)
+  if check and digest(base) != patch["base"]:
+    raise ValueError("The patch was made for another KMP.")
+  sections, version = kmp_sections(base)
+  patched = {x["section"]: x for x in patch["sections"]}
+  data = []
+  for name in patch.get("order", list(sections.keys())):
+    if name in patched:
+      data.append(patch_section(name, sections.get(name), patched[name]))
+    elif name in sections:
+      entry, option, body = sections[name]
+      data.append(SECTION_HEADER.pack(name.encode("utf-8"), entry, option) + body)
+    else:
+      raise ValueError(name + " not found.")
+  result = build_kmp(data, patch.get("version", version))
+  if check and digest(result) != patch["result"]:
+    raise ValueError("The patched KMP differs from the one the patch was made from.")
+  return result
+
+
+def summary(patch:dict) -> list:
+  """
+  -> ["GOBJ: 1 changed, 0 inserted, 0 removed", ...]
+  """
+  lines = []
+  for x in patch["sections"]:
+    if "data" in x:
+      lines.append(f"{x['section']}: replaced")
+      continue
+    counts = [len(x.get(key, [])) for key in ["changed", "inserted", "removed"]]
+    lines.append(f"{x['section']}: {counts[0]} changed, {counts[1]} inserted, {counts[2]} removed")
+  return lines
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  commands = parser.add_subparsers(dest="command", required=True)
+  diff_parser = commands.add_parser("diff", help='Write the entry level patch from a KMP to another one')
+  diff_parser.add_argument('base', help='Original KMP (or SZS)')
+  diff_parser.add_argument('result', help='Edited KMP (or SZS)')
+  diff_parser.add_argument('--patch', default=None, help='Output patch (JSON) path (default: stdout)')
+  diff_parser.add_argument('-o', '--overwrite', action='store_true', dest='o', help='If enabled, allows overwriting.')
+  patch_parser = commands.add_parser("patch", help='Apply a patch to a KMP')
+  patch_parser.add_argument('base', help='Original KMP (or SZS)')
+  patch_parser.add_argument('patch', help='Patch (JSON) written by diff')
+  patch_parser.add_argument('--kmp', required=True, help='Output KMP path, .szs replaces course.kmp in the archive')
+  patch_parser.add_argument('--szs', default=None,
+      help='Archive holding the other files of an output .szs (default: base if it is an archive, else the output)')
+  patch_parser.add_argument('--force', action='store_true', help='Apply even if the base is not the patched KMP')
+  patch_parser.add_argument('-o', '--overwrite', action='store_true', dest='o', help='If enabled, allows overwriting.')
+
+  arg = parser.parse_args()
+  output = arg.patch if arg.command == "diff" else arg.kmp
+  if output is not None and not arg.o and os.path.exists(output):
+    raise FileExistsError(output + " arleady exists.")
+
+  if arg.command == "diff":
+    patch = diff_kmp(arg.base, arg.result)
+    text = json.dumps(patch, separators=(",", ":"))
+    if arg.patch is None:
+      print(text)
+    else:
+      with open(arg.patch, "w", encoding="utf-8") as f:
+        f.write(text)
+    for line in summary(patch) or ["no difference"]:
+      print(line, file=sys.stderr)
+  else:
+    from x2k import write_output
+    with open(arg.patch, "r", encoding="utf-8") as f:
+      patch = json.load(f)
+    szs = arg.szs
+    if szs is None and is_archive(arg.base):
+      szs = arg.base
+    write_output(arg.kmp, apply_patch(arg.base, patch, not arg.force), szs)
+    print(f"{arg.base} + {arg.patch} -> {arg.kmp}")
@@ -0,0 +1,201 @@
+from binfunc import MappedParser
+from schema import POTI_ROUTE, RECORDS, SECTION_HEADER
+from szs import is_archive, szs_kmp
+
+
+class Entry(object):
+  """
+  View of one entry in the raw buffer, a field is unpacked when it is read.
+  entry["Pos x"], entry.keys(), entry.to_dict()
+  """
+  __slots__ = ("record", "buffer", "address")
+
+  def __init__(self, record, buffer, address:int):
+    self.record = record
+    self.buffer = buffer
+    self.address = address
+
+  def __getitem__(self, key:str):
+    try:
+      field, offset = self.record.offsets[key]
+    except KeyError:
+      raise KeyError(self.record.name + ": '" + key + "' not found.") from None
+    return field.unpack_from(self.buffer, self.address + offset)[0]
+
+  def keys(self) -> list:
+    return [key for key, _ in self.record.fields]
+
+  def to_dict(self) -> dict:
+    return dict(zip(self.keys(), self.record.struct.unpack_from(self.buffer, self.address)))
+
+  def __repr__(self):
+    return f"<{self.record.name} entry at {self.address:#x}>"
+
+
+class Section(object):
+  """
+  Section of a KmpFile, decoded only when its entries are accessed.
+  POTI entries are the points of all routes (routes : route headers).
+  """
+  __slots__ = ("kmp", "name", "entry", "option", "head", "address", "end", "_array", "_routes", "_addresses")
+
+  def __init__(self, kmp, name:str, entry:int, option:int, address:int, end:int):
+    self.kmp = kmp
+    self.name = name
+    self.entry = entry
+    self.option = option
+    self.head = address - SECTION_HEADER.size
+    self.address = address
+    self.end = end
+    self._array = None
+    self._routes = None
+    self._addresses = None
+
+  @property
+  def record(self):
+    if self.name not in RECORDS:
+      raise ValueError("Invalid header name.")
+    return RECORDS[self.name]
+
+  @property
+  def nbytes(self) -> int:
+    """
+    size of the section (header included)
+    """
+    return self.end - self.head
+
+  @property
+  def count(self) -> int:
+    """
+    number of entries (POTI : points)
+    """
+    return self.option if self.name == "POTI" else self.entry
+
+  @property
+  def array(self):
+    """
+    structured array of the entries (view of the buffer, decoded once)
+    """
+    if self._array is None:
+      if self.name == "POTI":
+        self._routes, self._array = self.kmp.parser.read_routes(self.entry, self.address, self.end)
+      else:
+        self._array = self.kmp.parser.read_entries(self.record, self.entry, self.address, self.end)
+    return self._array
+
+  @property
+  def routes(self):
+    if self.name != "POTI":
+      raise ValueError(self.name + " has no routes.")
+    self.array
+    return self._routes
+
+  def entry_addresses(self) -> list:
+    if self._addresses is None:
+      size = self.record.size
+      if self.name != "POTI":
+        self._addresses = range(self.address, self.address + self.entry*size, size)
+      else:
+        # walk the route headers only
+        addresses = []
+        address = self.address
+        for i in range(self.entry):
+          num = POTI_ROUTE.offsets["_points"][0].unpack_from(self.kmp.parser.buffer, address)[0]
+          address += POTI_ROUTE.size
+          addresses += range(address, address + num*size, size)
+          address += num*size
+        self._addresses = addresses
+      if len(self._addresses) > 0 and self._addresses[-1] + size > self.end:
+        raise ValueError(self.name + " exceeds its section.")
+    return self._addresses
+
+  def __len__(self) -> int:
+    return len(self.entry_addresses())
+
+  def __getitem__(self, index:int) -> Entry:
+    return Entry(self.record, self.kmp.parser.buffer, self.entry_addresses()[index])
+
+  def __iter__(self):
+    buffer = self.kmp.parser.buffer
+    for address in self.entry_addresses():
+      yield Entry(self.record, buffer, address)
+
+  def __repr__(self):
+    return f"<{self.name} section: {self.entry} entries, {self.nbytes} bytes>"
+
+
+class KmpFile(object):
+  """
+  Random access KMP reader.
+  The header and the offset table are read when opened, sections are decoded on access.
+
+  with KmpFile("course.kmp") as kmp:
+    kmp["GOBJ"][3]["Object"]
+  source : path or bytes (KMP, or SZS / U8 archive holding it)
+  """
+  def __init__(self, source):
+    if is_archive(source):
+      source = szs_kmp(source)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+      self.file = None
+      self.parser = MappedParser(source)
+    else:
+      self.file = open(source, "rb")
+      try:
+        self.parser = MappedParser(self.file)
+      except Exception:
+        self.file.close()
+        raise
+    self.sections = {}
+    for name, entry, option, address, end in self.parser.sections():
+      self.sections[name] = Section(self, name, entry, option, address, end)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.sections = {}
+    self.parser.close()
+    if self.file is not None:
+      self.file.close()
+
+  @property
+  def file_length(self) -> int:
+    return self.parser.file_length
+
+  @property
+  def version(self) -> int:
+    return self.parser.version
+
+  def keys(self) -> list:
+    return list(self.sections.keys())
+
+  def __contains__(self, name:str) -> bool:
+    return name in self.sections
+
+  def __getitem__(self, name:str) -> Section:
+    try:
+      return self.sections[name]
+    except KeyError:
+      raise KeyError(name + " not found.") from None
+
+  def __iter__(self):
+    return iter(self.sections.values())
+
+  def stats(self) -> list:
+    """
+    -> [(section name, entries, points (POTI) or None, bytes)] from the section headers only
+    """
+    return [(x.name, x.entry, x.option if x.name == "POTI" else None, x.nbytes) for x in self]
+
+
+def print_stats(path:str):
+  with KmpFile(path) as kmp:
+    stats = kmp.stats()
+    print(f"{path} : version {kmp.version}, {len(stats)} sections, {kmp.file_length} bytes")
+    for name, entry, points, nbytes in stats:
+      points = "" if points is None else f" ({points} points)"
+      print(f"  {name} {entry:6d} entries {nbytes:9d} bytes{points}")
@@ -0,0 +1,141 @@
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+
+# Profiler of the running conversion (None : profiling disabled, hooks do nothing)
+_active = None
+
+
+class Profiler(object):
+  """
+  Wall time, I/O (bytes and calls) and peak memory per (phase, section).
+  """
+  def __init__(self, memory:bool=True):
+    self.memory = memory
+    self.records = []
+    self.current = None
+    self.seconds = 0.0
+    self.peak_memory = 0
+
+  def new_record(self, phase:str, section:str) -> dict:
+    return {
+        "phase": phase, "section": section, "seconds": 0.0,
+        "bytes_read": 0, "reads": 0, "bytes_written": 0, "writes": 0, "peak_memory": 0}
+
+  @contextmanager
+  def phase(self, phase:str, section:str=None):
+    record = self.new_record(phase, section)
+    parent, self.current = self.current, record
+    if self.memory and hasattr(tracemalloc, "reset_peak"): # python 3.9+
+      # the peak of the enclosing phase so far is kept before the reset
+      outer = tracemalloc.get_traced_memory()[1]
+      if parent is not None:
+        parent["peak_memory"] = max(parent["peak_memory"], outer)
+      self.peak_memory = max(self.peak_memory, outer)
+      tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+      yield record
+    finally:
+      record["seconds"] = time.perf_counter() - start
+      if self.memory:
+        record["peak_memory"] = max(record["peak_memory"], tracemalloc.get_traced_memory()[1])
+        self.peak_memory = max(self.peak_memory, record["peak_memory"])
+      self.records.append(record)
+      self.current = parent
+
+  def count(self, kind:str, nbytes:int):
+    """
+    kind : "read" or "write"
+    """
+    if self.current is None:
+      self.current = self.new_record("other", None)
+      self.records.append(self.current)
+    self.current["bytes_" + ("read" if kind == "read" else "written")] += nbytes
+    self.current[kind + "s"] += 1
+
+  def report(self) -> dict:
+    summary = {}
+    for record in self.records:
+      x = summary.setdefault(record["phase"], self.new_record(record["phase"], None))
+      for key in ["seconds", "bytes_read", "reads", "bytes_written", "writes"]:
+        x[key] += record[key]
+      x["peak_memory"] = max(x["peak_memory"], record["peak_memory"])
+    for x in summary.values():
+      del x["phase"], x["section"]
+    return {
+        "seconds": self.seconds, "peak_memory": self.peak_memory if self.memory else None,
+        "phases": summary, "sections": self.records}
+
+
+@contextmanager
+def profile(memory:bool=True, cprofile:str=None):
+  """
+  Profile the conversions run inside the block.
+
+  with profile() as prof:
+    kmp_dump(path, dest)
+  prof.report()
+  """
+  global _active
+  prof = Profiler(memory)
+  _active = prof
+  if memory:
+    tracemalloc.start()
+  if cprofile is not None:
+    import cProfile
+    cp = cProfile.Profile()
+    cp.enable()
+  start = time.perf_counter()
+  try:
+    yield prof
+  finally:
+    prof.seconds = time.perf_counter() - start
+    if cprofile is not None:
+      cp.disable()
+      cp.dump_stats(cprofile)
+    if memory:
+      prof.peak_memory = max(prof.peak_memory, tracemalloc.get_traced_memory()[1])
+      tracemalloc.stop()
+    _active = None
+
+
+@contextmanager
+def phase(name:str, section:str=None):
+  if _active is None:
+    yield None
+  else:
+    with _active.phase(name, section) as record:
+      yield record
+
+
+def count(kind:str, nbytes:int):
+  if _active is not None:
+    _active.count(kind, nbytes)
+
+
+def write_report(prof:Profiler, path:str):
+  """
+  path : JSON path ("-" : stdout)
+  """
+  data = json.dumps(prof.report(), indent=2)
+  if path == "-":
+    print(data)
+  else:
+    with open(path, "w") as f:
+      f.write(data)
+
+
+def run(func, *args, report:str=None, cprofile:str=None):
+  """
+  func(*args), profiled when report (JSON path, "-" : stdout) or cprofile (pstats path) is given
+  """
+  if report is None and cprofile is None:
+    return func(*args)
+  with profile(cprofile=cprofile) as prof:
+    result = func(*args)
+  if report is not None:
+    write_report(prof, report)
+  return result
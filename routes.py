@@ -0,0 +1,116 @@
+from schema import PATH_SHEETS
+
+
+# "no link" value of path and CKPT link bytes
+NO_LINK = 255
+
+
+def excel_row(index:int) -> int:
+  """
+  table row index -> Excel row number (after the header row)
+  """
+  return int(index) + 2
+
+
+class PathGraph(object):
+  """
+  Points grouped in paths (ENPT/ENPH, ITPT/ITPH, CKPT/CKPH) as index arrays.
+  Group i holds the points starts[i] to starts[i]+lengths[i]-1.
+  """
+  def __init__(self, starts, lengths, points:int):
+    import numpy as np
+    self.starts = np.asarray(starts, np.int64)
+    self.lengths = np.asarray(lengths, np.int64)
+    self.points = points
+
+  @classmethod
+  def from_ids(cls, ids, sheet:str=None):
+    """
+    Group ID column (empty except on the first row of each group) -> PathGraph
+    """
+    import numpy as np
+    ids = np.asarray(ids, np.float64)
+    starts = np.flatnonzero(~np.isnan(ids))
+    if len(ids) > 0 and (len(starts) == 0 or starts[0] != 0):
+      raise ValueError(f"{sheet}: row {excel_row(0)} must start a group (ID is empty).")
+    return cls(starts, np.diff(np.append(starts, len(ids))), len(ids))
+
+  @property
+  def groups(self) -> int:
+    return len(self.starts)
+
+  @property
+  def firsts(self):
+    """
+    bool per point, first point of its group
+    """
+    import numpy as np
+    x = np.zeros(self.points, bool)
+    x[self.starts[self.lengths > 0]] = True
+    return x
+
+  def group_of(self):
+    """
+    group index per point
+    """
+    import numpy as np
+    return np.repeat(np.arange(self.groups), self.lengths)
+
+  def ckpt_links(self) -> tuple:
+    """
+    -> (prev, next) CKPT indexes inside each group
+    Same values as the links written by the previous converters (kept for byte compatibility):
+    a point after a single point group has no links and a group of one point has no next.
+    """
+    import numpy as np
+    n = self.points
+    # starts[k] : point k starts a group (False past the end)
+    starts = np.zeros(n+2, bool)
+    starts[self.starts[self.starts < n]] = True
+    j = np.arange(n-1) # previous point of the points 1..n-1
+    single = starts[j] & starts[j+1]
+    last = (j+2 == n) | starts[j+2]
+    prev = np.where(single | (~last & starts[j+1]), NO_LINK, j)
+    next = np.where(single | last, NO_LINK, j+2)
+    return np.append([NO_LINK], prev)[:n], np.append([1], next)[:n]
+
+  def missing_groups(self, values):
+    """
+    group links (Last n, Next n of the group rows) -> bool per value, not a group index nor 255
+    """
+    import numpy as np
+    values = np.asarray(values, np.float64)
+    return ~np.isnan(values) & (values != NO_LINK) & ((values < 0) | (values >= self.groups))
+
+  def missing_points(self, values):
+    """
+    point links (CKPT Prev, Next) -> bool per value, not a point index nor 255
+    """
+    import numpy as np
+    values = np.asarray(values, np.float64)
+    return ~np.isnan(values) & (values != NO_LINK) & ((values < 0) | (values >= self.points))
+
+
+def path_columns(table:dict, sheet:str) -> tuple:
+  """
+  points and paths sheet -> (PathGraph, point columns, path columns) ready to encode
+  CKPT Prev and Next are derived from the groups where they are empty (or missing).
+  Links are written as they are, see validate.check_sheet for the missing groups and points.
+  """
+  import numpy as np
+  pt, ph = PATH_SHEETS[sheet]
+  graph = PathGraph.from_ids(table[ph + " ID"], sheet)
+
+  points = dict(table)
+  if pt == "CKPT":
+    derived = dict(zip(["Prev", "Next"], graph.ckpt_links()))
+    for clm, values in derived.items():
+      if clm in table:
+        given = np.asarray(table[clm], np.float64)
+        values = np.where(np.isnan(given), values, given)
+      points[clm] = values
+
+  paths = {key: np.asarray(values)[graph.starts] for key, values in table.items()}
+  paths["_start"] = graph.starts
+  paths["_length"] = graph.lengths
+  return graph, points, paths
@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from struct import Struct
+
+
+# struct format -> numpy type (big-endian)
+_TYPES = {"B": "u1", "b": "i1", "H": ">u2", "h": ">i2", "I": ">u4", "i": ">i4", "f": ">f4"}
+
+
+class Record(object):
+  """
+  Record layout of a KMP section entry.
+  fields : [(name, struct format)], "_" prefixed names are padding or raw values (not Excel columns).
+  """
+  def __init__(self, name:str, fields:list):
+    self.name = name
+    self.fields = fields
+    self.struct = Struct(">" + "".join([fmt for _, fmt in fields]))
+    self.columns = [key for key, _ in fields if not key.startswith("_")]
+    self._dtype = None
+    # single field access : {name: (Struct, offset in the entry)}
+    self.offsets = {}
+    offset = 0
+    for key, fmt in fields:
+      self.offsets[key] = (Struct(">" + fmt), offset)
+      offset += self.offsets[key][0].size
+
+  @property
+  def size(self) -> int:
+    return self.struct.size
+
+  @property
+  def dtype(self):
+    """
+    numpy structured dtype (numpy is imported on first use)
+    """
+    if self._dtype is None:
+      import numpy as np
+      self._dtype = np.dtype([(key, _TYPES[fmt]) for key, fmt in self.fields])
+    return self._dtype
+
+  def decode(self, buffer, count:int, offset:int=0):
+    """
+    bytes -> structured array (big-endian view of buffer)
+    """
+    import numpy as np
+    return np.frombuffer(buffer, self.dtype, count=count, offset=offset)
+
+  def encode(self, columns:dict, count:int) -> bytes:
+    """
+    {field name: values} -> bytes
+    Missing "_" fields are written as 0.
+    """
+    import numpy as np
+    arr = np.zeros(count, self.dtype)
+    for key in self.dtype.names:
+      if key not in columns:
+        if key.startswith("_"):
+          continue
+        raise KeyError(self.name + ": '" + key + "' not found.")
+      arr[key] = self.cast(key, columns[key])
+    return arr.tobytes()
+
+  def cast(self, key:str, values):
+    import numpy as np
+    values = np.asarray(values)
+    kind = self.dtype[key]
+    if kind.kind == "f":
+      return values.astype(np.float64)
+    if values.dtype.kind not in "iub":
+      values = values.astype(np.float64)
+      if np.isnan(values).any():
+        raise ValueError(self.name + ": '" + key + "' has empty cells.")
+    info = np.iinfo(kind)
+    if len(values) > 0 and (values.min() < info.min or values.max() > info.max):
+      raise OverflowError(self.name + ": '" + key + "' out of range.")
+    return values.astype(np.int64)
+
+
+_POS = [("Pos x", "f"), ("Pos y", "f"), ("Pos z", "f")]
+_POS_ROT = _POS + [("Rot x", "f"), ("Rot y", "f"), ("Rot z", "f")]
+_VEC9 = _POS_ROT + [("Scale x", "f"), ("Scale y", "f"), ("Scale z", "f")]
+_PATH = [("_start", "B"), ("_length", "B")] + \
+        [("Last %d" % (i+1), "B") for i in range(6)] + \
+        [("Next %d" % (i+1), "B") for i in range(6)]
+
+# Section order of the KMP file
+RECORDS = OrderedDict([
+    ("KTPT", Record("KTPT", _POS_ROT + [("PlayerIdx", "h"), ("_pad", "H")])),
+    ("ENPT", Record("ENPT", _POS + [("Range", "f"), ("Setting1", "H"), ("Setting2", "B"), ("Setting3", "B")])),
+    ("ENPH", Record("ENPH", _PATH + [("Dispatch1", "B"), ("Dispatch2", "B")])),
+    ("ITPT", Record("ITPT", _POS + [("Range", "f"), ("Setting1", "H"), ("Setting2", "H")])),
+    ("ITPH", Record("ITPH", _PATH + [("_pad", "H")])),
+    ("CKPT", Record("CKPT", [("Left x", "f"), ("Left y", "f"), ("Right x", "f"), ("Right y", "f"),
+                             ("Respawn", "B"), ("Type", "B"), ("Prev", "B"), ("Next", "B")])),
+    ("CKPH", Record("CKPH", _PATH + [("_pad", "H")])),
+    ("GOBJ", Record("GOBJ", [("_objects", "H"), ("_reference", "H")] + _VEC9 + [("Route", "H")] +
+                            [("Setting%d" % (i+1), "H") for i in range(8)] + [("_presence", "H")])),
+    ("POTI", Record("POTI", _POS + [("Setting1", "H"), ("Setting2", "H")])),
+    ("AREA", Record("AREA", [("Shape", "B"), ("Type", "B"), ("Camera", "B"), ("Priority", "B")] + _VEC9 +
+                            [("Setting 1", "H"), ("Setting 2", "H"), ("Route", "B"), ("Enemy", "B"),
+                             ("_pad", "H")])),
+    ("CAME", Record("CAME", [("Type", "B"), ("Next", "B"), ("_pad1", "B"), ("Route", "B"),
+                             ("Camera velocity", "H"), ("Zoom velocity", "H"), ("View velocity", "H"),
+                             ("_pad2", "H")] + _POS_ROT + [("ZoomStart", "f"), ("ZoomEnd", "f"),
+                             ("Start pos x", "f"), ("Start pos y", "f"), ("Start pos z", "f"),
+                             ("End pos x", "f"), ("End pos y", "f"), ("End pos z", "f"), ("Time", "f")])),
+    ("JGPT", Record("JGPT", _POS_ROT + [("_pad", "H"), ("Range", "h")])),
+    ("CNPT", Record("CNPT", _POS_ROT + [("Cannon ID", "H"), ("Shoot", "h")])),
+    ("MSPT", Record("MSPT", _POS_ROT + [("Entry", "H"), ("_pad", "H")])),
+    # speed factor : float(single precision), but only 16-bit(MSB) is stored
+    ("STGI", Record("STGI", [("Lap", "B"), ("Pole", "B"), ("Distance", "B"), ("Flare", "B"), ("_pad1", "B"),
+                             ("Flare R", "B"), ("Flare G", "B"), ("Flare B", "B"), ("Flare A", "B"),
+                             ("_pad2", "B"), ("_speed", "H")])),
+    ])
+# POTI entry = route header + points (RECORDS["POTI"])
+POTI_ROUTE = Record("POTI", [("_points", "H"), ("PointSetting 1", "B"), (" PointSetting 2", "B")])
+
+# GOBJ XPF bit fields : (column, shift, bits)
+# http://wiki.tockdom.com/wiki/Extended_presence_flags/Technical_Description
+XPF_OBJECTS = [("Type(LE)", 13, 3), ("Enable(LE)", 12, 1), ("Object", 0, 10)]
+XPF_PRESENCE = [("MODE", 12, 4), ("Parameters", 6, 6), ("Multi(>2)", 2, 1), ("Multi(<3)", 1, 1), ("Single", 0, 1)]
+
+# magic, file length, sections, header length, version (+ uint32 offsets)
+FILE_HEADER = Struct(">4sIHHI")
+# name, entry, option (CAME: first camera indexes, POTI: total points)
+SECTION_HEADER = Struct(">4sHH")
+HEADER_LENGTH = FILE_HEADER.size + 4*len(RECORDS)
+VERSION = 2520
+
+# Converter version, bump when decoded tables or encoded bytes change (cache keys).
+CONVERTER_VERSION = "3"
+
+# Excel sheets and columns
+# points and paths (ENPT+ENPH, ...) share one sheet, the path is written on the first point of its group.
+PATH_SHEETS = OrderedDict([
+    ("ENPT+ENPH", ("ENPT", "ENPH")),
+    ("ITPT+ITPH", ("ITPT", "ITPH")),
+    ("CKPT+CKPH", ("CKPT", "CKPH")),
+    ])
+SHEETS = OrderedDict([
+    ("KTPT", RECORDS["KTPT"].columns),
+    ("ENPT+ENPH", RECORDS["ENPT"].columns + ["ENPH ID"] + RECORDS["ENPH"].columns),
+    ("ITPT+ITPH", RECORDS["ITPT"].columns + ["ITPH ID"] + RECORDS["ITPH"].columns),
+    ("CKPT+CKPH", RECORDS["CKPT"].columns + ["CKPH ID"] + RECORDS["CKPH"].columns),
+    ("GOBJ", [x[0] for x in XPF_OBJECTS] + ["Reference (hex)"] + RECORDS["GOBJ"].columns +
+             [x[0] for x in XPF_PRESENCE]),
+    ("POTI", ["ID"] + POTI_ROUTE.columns + RECORDS["POTI"].columns),
+    ("AREA", RECORDS["AREA"].columns),
+    ("CAME", RECORDS["CAME"].columns[:1] + ["First1", "First2"] + RECORDS["CAME"].columns[1:]),
+    ("JGPT", RECORDS["JGPT"].columns),
+    ("CNPT", RECORDS["CNPT"].columns),
+    ("MSPT", RECORDS["MSPT"].columns),
+    ("STGI", RECORDS["STGI"].columns + ["Speed Factor"]),
+    ])
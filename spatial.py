@@ -0,0 +1,300 @@
+import argparse
+import sys
+import time
+from collections import OrderedDict
+
+from batch import expand_paths
+from kmpfile import KmpFile
+
+
+# point sets : name -> (section, x, y, z columns), y None : checkpoints, indexed on (x, z)
+POINT_SETS = OrderedDict([
+    ("KTPT", ("KTPT", "Pos x", "Pos y", "Pos z")),
+    ("ENPT", ("ENPT", "Pos x", "Pos y", "Pos z")),
+    ("ITPT", ("ITPT", "Pos x", "Pos y", "Pos z")),
+    ("CKPT left", ("CKPT", "Left x", None, "Left y")),
+    ("CKPT right", ("CKPT", "Right x", None, "Right y")),
+    ("GOBJ", ("GOBJ", "Pos x", "Pos y", "Pos z")),
+    ("POTI", ("POTI", "Pos x", "Pos y", "Pos z")),
+    ("AREA", ("AREA", "Pos x", "Pos y", "Pos z")),
+    ("JGPT", ("JGPT", "Pos x", "Pos y", "Pos z")),
+    ("CNPT", ("CNPT", "Pos x", "Pos y", "Pos z")),
+    ("MSPT", ("MSPT", "Pos x", "Pos y", "Pos z")),
+    ])
+
+# AREA at scale 1 : half width (x, z) and height (y, from the position up)
+AREA_HALF_WIDTH = 5000.0
+AREA_HEIGHT = 10000.0
+AREA_BOX, AREA_CYLINDER = 0, 1
+
+# pairs() : centers per chunk, candidate points per chunk (memory bound)
+PAIRS_CHUNK = 4096
+PAIRS_CANDIDATES = 1 << 20
+
+
+class SpatialIndex(object):
+  """
+  Uniform grid over points (n, 2 or 3), the points of a cell are contiguous in key order.
+  Rows with NaN are not indexed. Every query is answered for all its centers at once.
+  cell : grid cell size (default : about one point per cell)
+  """
+  def __init__(self, points, cell:float=None):
+    import numpy as np
+    self.points = np.asarray(points, np.float64)
+    if self.points.ndim != 2:
+      raise ValueError("points must be an (n, dims) array.")
+    self.dims = self.points.shape[1]
+    valid = np.flatnonzero(~np.isnan(self.points).any(axis=1))
+    lo = self.points[valid].min(axis=0) if len(valid) > 0 else np.zeros(self.dims)
+    hi = self.points[valid].max(axis=0) if len(valid) > 0 else np.zeros(self.dims)
+    if cell is None:
+      cell = float((hi - lo).max()) / max(1, round(len(valid) ** (1 / self.dims)))
+    self.cell = cell if cell > 0 else 1.0
+    self.origin = lo
+    self.shape = np.floor((hi - lo) / self.cell).astype(np.int64) + 1
+    if np.prod(self.shape.astype(np.float64)) >= 2**62:
+      raise ValueError(f"Cell size {self.cell} is too small for the extent of the points.")
+    keys = np.ravel_multi_index(tuple(self.cell_of(self.points[valid]).T), tuple(self.shape))
+    order = np.argsort(keys, kind="stable")
+    self.keys = keys[order]
+    self.entries = valid[order]
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def cell_of(self, points):
+    import numpy as np
+    return np.floor((points - self.origin) / self.cell).astype(np.int64)
+
+  def pairs(self, centers, radius) -> tuple:
+    """
+    centers (q, dims), radius (scalar or per center) -> (center indexes, point indexes, distances)
+    of every point within radius of a center (in no particular order)
+    """
+    import numpy as np
+    centers = np.asarray(centers, np.float64).reshape(-1, self.dims)
+    radius = np.broadcast_to(np.asarray(radius, np.float64), (len(centers),))
+    ok = ~np.isnan(centers).any(axis=1) & ~np.isnan(radius) & (radius >= 0)
+    if len(self.entries) == 0 or not ok.any():
+      return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+
+    # balls of similar size share a chunk (and the same cell offsets)
+    which = np.flatnonzero(ok)
+    which = which[np.argsort(radius[which], kind="stable")]
+    results = []
+    start = 0
+    while start < len(which):
+      span = np.minimum(np.ceil(2 * radius[which[min(start+PAIRS_CHUNK, len(which))-1]] / self.cell) + 2, self.shape)
+      size = max(1, min(PAIRS_CHUNK, PAIRS_CANDIDATES // int(min(np.prod(span), len(self.entries)))))
+      chunk = which[start:start+size]
+      query, points, distance = self.chunk_pairs(centers[chunk], radius[chunk])
+      results.append((chunk[query], points, distance))
+      start += size
+    return tuple([np.concatenate(x) for x in zip(*results)])
+
+  def chunk_pairs(self, centers, radius) -> tuple:
+    import numpy as np
+    # cell range of each ball (clipped to the grid), the same offsets are tried for every center
+    last = self.shape - 1
+    lo = np.clip(np.floor((centers - radius[:, None] - self.origin) / self.cell), 0, last).astype(np.int64)
+    hi = np.clip(np.floor((centers + radius[:, None] - self.origin) / self.cell), 0, last).astype(np.int64)
+    widths = (hi - lo + 1).max(axis=0)
+    if np.prod(widths) >= len(self.entries):
+      # more cells than points : distances to every point
+      distance = np.sqrt(((centers[:, None, :] - self.points[self.entries][None, :, :])**2).sum(axis=-1))
+      query, i = np.nonzero(distance <= radius[:, None])
+      return query, self.entries[i], distance[query, i]
+    offsets = np.stack(np.meshgrid(*[np.arange(w) for w in widths], indexing="ij"), -1).reshape(-1, self.dims)
+    cells = lo[:, None, :] + offsets[None, :, :]
+    inside = (cells <= hi[:, None, :]).all(axis=-1)
+    keys = np.full(inside.shape, -1, np.int64)
+    keys[inside] = np.ravel_multi_index(tuple(cells[inside].T), tuple(self.shape))
+    starts = np.searchsorted(self.keys, keys, "left").ravel()
+    counts = np.searchsorted(self.keys, keys, "right").ravel() - starts
+    # expand the key ranges to candidate points
+    query = np.repeat(np.repeat(np.arange(len(centers)), len(offsets)), counts)
+    first = np.cumsum(counts) - counts
+    candidate = self.entries[np.repeat(starts - first, counts) + np.arange(counts.sum())]
+    distance = np.sqrt(((self.points[candidate] - centers[query])**2).sum(axis=1))
+    keep = distance <= radius[query]
+    return query[keep], candidate[keep], distance[keep]
+
+  def within(self, center, radius:float) -> tuple:
+    """
+    -> (point indexes, distances) within radius of center, nearest first
+    """
+    import numpy as np
+    _, points, distances = self.pairs([center], radius)
+    order = np.lexsort((points, distances))
+    return points[order], distances[order]
+
+  def nearest(self, queries) -> tuple:
+    """
+    queries (q, dims) -> (nearest point index (-1 : none), distance) per query, exact
+    The search radius starts at one cell and doubles for the queries without a point inside it.
+    """
+    import numpy as np
+    queries = np.asarray(queries, np.float64).reshape(-1, self.dims)
+    index = np.full(len(queries), -1, np.int64)
+    distance = np.full(len(queries), np.inf)
+    todo = np.flatnonzero(~np.isnan(queries).any(axis=1))
+    if len(self.entries) == 0:
+      return index, distance
+    radius = np.full(len(queries), self.cell)
+    while len(todo) > 0:
+      query, points, d = self.pairs(queries[todo], radius[todo])
+      order = np.lexsort((points, d, query))
+      query, points, d = query[order], points[order], d[order]
+      first = np.flatnonzero(np.append(True, query[1:] != query[:-1])) if len(query) > 0 else query
+      found = todo[query[first]]
+      index[found], distance[found] = points[first], d[first]
+      todo = np.setdiff1d(todo, found)
+      radius[todo] *= 2
+    return index, distance
+
+
+def rotation_matrices(rotations):
+  """
+  (n, 3) Euler angles in degrees -> (n, 3, 3), rotated around x, then y, then z
+  """
+  import numpy as np
+  x, y, z = np.radians(np.asarray(rotations, np.float64)).T
+  one, zero = np.ones_like(x), np.zeros_like(x)
+  rx = np.stack([one, zero, zero, zero, np.cos(x), -np.sin(x), zero, np.sin(x), np.cos(x)], -1)
+  ry = np.stack([np.cos(y), zero, np.sin(y), zero, one, zero, -np.sin(y), zero, np.cos(y)], -1)
+  rz = np.stack([np.cos(z), -np.sin(z), zero, np.sin(z), np.cos(z), zero, zero, zero, one], -1)
+  return rz.reshape(-1, 3, 3) @ ry.reshape(-1, 3, 3) @ rx.reshape(-1, 3, 3)
+
+
+class CourseIndex(object):
+  """
+  Positions of a course with a SpatialIndex per point set, built on first use.
+
+  course = CourseIndex("course.kmp")
+  course.within((0, 1000, 0), 3000, ["GOBJ", "ITPT"])
+  source : KMP or SZS (path or bytes)
+  """
+  def __init__(self, source, cell:float=None):
+    import numpy as np
+    self.cell = cell
+    self.positions = OrderedDict()
+    self.indexes = {}
+    with KmpFile(source) as kmp:
+      for name, (section, x, y, z) in POINT_SETS.items():
+        if section in kmp:
+          arr = kmp[section].array
+          self.positions[name] = np.column_stack([arr[clm].astype(np.float64) for clm in [x, y, z] if clm is not None])
+      self.areas = kmp["AREA"].array.copy() if "AREA" in kmp else None
+      self.respawns = kmp["CKPT"].array["Respawn"].astype(np.int64) if "CKPT" in kmp else None
+
+  def points(self, name:str, dims:int=None):
+    """
+    -> positions of a point set, (x, z) only if dims is 2
+    """
+    if name not in self.positions:
+      raise KeyError(name + " not found.")
+    points = self.positions[name]
+    return points[:, [0, 2]] if dims == 2 and points.shape[1] == 3 else points
+
+  def index(self, name:str, dims:int=None) -> SpatialIndex:
+    points = self.points(name, dims)
+    key = (name, points.shape[1])
+    if key not in self.indexes:
+      self.indexes[key] = SpatialIndex(points, self.cell)
+    return self.indexes[key]
+
+  def within(self, point, radius:float, names:list=None) -> list:
+    """
+    (x, y, z), radius -> [(point set, entry, distance)] nearest first
+    Checkpoints are compared on (x, z).
+    """
+    result = []
+    for name in names or list(self.positions.keys()):
+      index = self.index(name)
+      center = point if index.dims == 3 else [point[0], point[2]]
+      entries, distances = index.within(center, radius)
+      result += [(name, int(i), float(d)) for i, d in zip(entries, distances)]
+    return sorted(result, key=lambda x: x[2])
+
+  def nearest_respawns(self) -> tuple:
+    """
+    -> (nearest JGPT per checkpoint (-1 : none), distance) on (x, z), from the middle of the checkpoint line
+    """
+    middle = (self.points("CKPT left") + self.points("CKPT right")) / 2
+    return self.index("JGPT", 2).nearest(middle)
+
+  def areas_containing(self, name:str="GOBJ") -> tuple:
+    """
+    -> (AREA entries, entries of the point set) of every point inside a box or cylinder AREA
+    Candidates are the points within the bounding sphere of each AREA, then tested in the AREA frame.
+    """
+    import numpy as np
+    if self.points(name).shape[1] != 3:
+      raise ValueError(name + " has no height.")
+    empty = np.zeros(0, np.int64)
+    if self.areas is None or len(self.areas) == 0:
+      return empty, empty
+    arr = self.areas
+    center = np.column_stack([arr[clm].astype(np.float64) for clm in ["Pos x", "Pos y", "Pos z"]])
+    rotation = np.column_stack([arr[clm].astype(np.float64) for clm in ["Rot x", "Rot y", "Rot z"]])
+    size = np.abs(np.column_stack([arr[clm].astype(np.float64) for clm in ["Scale x", "Scale y", "Scale z"]]))
+    size *= [AREA_HALF_WIDTH, AREA_HEIGHT, AREA_HALF_WIDTH]
+    matrices = rotation_matrices(rotation)
+    # bounding sphere around the middle of the AREA (the position is at the bottom)
+    middle = center + matrices[:, :, 1] * (size[:, 1:2] / 2)
+    area, point, _ = self.index(name, 3).pairs(middle, np.sqrt((size**2 * [1, 0.25, 1]).sum(axis=1)))
+
+    # row vector @ R = R^T applied : position in the AREA frame
+    local = np.einsum("nk,nkj->nj", self.points(name)[point] - center[area], matrices[area])
+    with np.errstate(divide="ignore", invalid="ignore"):
+      x, y, z = (local / size[area]).T
+    shape = arr["Shape"].astype(np.int64)[area]
+    inside = (y >= 0) & (y <= 1) & (
+        ((shape == AREA_BOX) & (np.abs(x) <= 1) & (np.abs(z) <= 1)) |
+        ((shape == AREA_CYLINDER) & (x**2 + z**2 <= 1)))
+    order = np.lexsort((point[inside], area[inside]))
+    return area[inside][order], point[inside][order]
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--kmp', required=True, help='KMP (or SZS) path, directory or glob')
+  parser.add_argument('--within', default=None, help='Point "x,y,z" : entries within --radius of it')
+  parser.add_argument('--radius', type=float, default=1000.0, help='Radius of --within')
+  parser.add_argument('--sets', default=None, help=f'Point sets of --within, comma separated ({", ".join(POINT_SETS)})')
+  parser.add_argument('--respawn', action='store_true', help='Nearest JGPT of each checkpoint and its Respawn')
+  parser.add_argument('--areas', nargs='?', const='GOBJ', default=None,
+      help='AREA boxes and cylinders containing each entry of a point set (default: GOBJ)')
+  parser.add_argument('--cell', type=float, default=None, help='Grid cell size (default: from the point count)')
+
+  arg = parser.parse_args()
+  if arg.within is None and not arg.respawn and arg.areas is None:
+    parser.error("--within, --respawn or --areas is required.")
+  point = None if arg.within is None else [float(x) for x in arg.within.split(",")]
+  if point is not None and len(point) != 3:
+    parser.error("--within must be x,y,z.")
+  sets = None if arg.sets is None else [x.strip() for x in arg.sets.split(",")]
+
+  paths = expand_paths(arg.kmp, ".kmp")
+  start = time.perf_counter()
+  failed = 0
+  for path in paths:
+    prefix = path + "\t" if len(paths) > 1 else ""
+    try:
+      course = CourseIndex(path, arg.cell)
+      if point is not None:
+        for name, entry, distance in course.within(point, arg.radius, sets):
+          print(f"{prefix}within\t{name}\t{entry}\t{distance:.2f}")
+      if arg.respawn:
+        nearest, distances = course.nearest_respawns()
+        for i, (jgpt, distance) in enumerate(zip(nearest.tolist(), distances.tolist())):
+          mark = "" if jgpt == course.respawns[i] else "\t*"
+          print(f"{prefix}respawn\tCKPT {i}\tRespawn {course.respawns[i]}\tnearest JGPT {jgpt}\t{distance:.2f}{mark}")
+      if arg.areas is not None:
+        for area, entry in zip(*[x.tolist() for x in course.areas_containing(arg.areas)]):
+          print(f"{prefix}area\tAREA {area}\t{arg.areas} {entry}")
+    except Exception as e:
+      failed += 1
+      print(f"{path} : FAILED ({type(e).__name__}: {e})", file=sys.stderr)
+  print(f"{len(paths)} courses ({time.perf_counter()-start:.2f}s)", file=sys.stderr)
+  sys.exit(int(failed > 0))
@@ -0,0 +1,304 @@
+from struct import Struct, pack_into
+
+
+# Yaz0 : magic, decompressed size, reserved (8 bytes), then groups of 8 chunks with a header byte
+YAZ0_HEADER = Struct(">4sI8x")
+YAZ0_WINDOW = 0x1000
+YAZ0_MAX_LENGTH = 0x111
+# candidates tried per position by the level 1 matcher
+YAZ0_CHAIN = 16
+
+# U8 : magic, root node offset, nodes + strings size, data offset (+ 16 reserved bytes)
+U8_MAGIC = b"\x55\xAA\x38\x2D"
+U8_HEADER = Struct(">4sIII")
+# type (8 bits) + name offset (24 bits), data offset (directory : parent), size (directory : end node)
+U8_NODE = Struct(">III")
+
+
+def yaz0_groups() -> list:
+  """
+  group header byte -> chunks (n > 0 : n literal bytes, 0 : back reference)
+  """
+  groups = []
+  for code in range(256):
+    chunks = []
+    for bit in range(8):
+      if code & (0x80 >> bit) == 0:
+        chunks.append(0)
+      elif len(chunks) > 0 and chunks[-1] > 0:
+        chunks[-1] += 1
+      else:
+        chunks.append(1)
+    groups.append(tuple(chunks))
+  return groups
+
+_GROUPS = yaz0_groups()
+
+
+def is_yaz0(data) -> bool:
+  return bytes(data[:4]) == b"Yaz0"
+
+
+def yaz0_decompress(data) -> bytes:
+  """
+  Yaz0 -> bytes
+  The output is allocated once from the header, literal runs and copies are sliced (no per-byte loop).
+  """
+  data = memoryview(data)
+  if len(data) < YAZ0_HEADER.size or not is_yaz0(data):
+    raise ValueError("Invalid Yaz0 header.")
+  size = YAZ0_HEADER.unpack_from(data)[1]
+  out = bytearray(size)
+  src, dst, end = YAZ0_HEADER.size, 0, len(data)
+  try:
+    while dst < size:
+      chunks = _GROUPS[data[src]]
+      src += 1
+      for chunk in chunks:
+        if dst >= size:
+          break
+        if chunk > 0:
+          n = min(chunk, size-dst)
+          if src+n > end:
+            raise ValueError("Truncated Yaz0 data.")
+          out[dst:dst+n] = data[src:src+n]
+          src += n
+          dst += n
+          continue
+        b1, b2 = data[src], data[src+1]
+        src += 2
+        dist = ((b1 & 0x0F) << 8 | b2) + 1
+        n = b1 >> 4
+        if n == 0:
+          n = data[src] + 0x12
+          src += 1
+        else:
+          n += 2
+        n = min(n, size-dst)
+        s = dst - dist
+        if s < 0:
+          raise ValueError("Invalid Yaz0 back reference.")
+        if dist >= n:
+          out[dst:dst+n] = out[s:s+n]
+        else:
+          # overlapping copy : the last dist bytes are repeated
+          out[dst:dst+n] = (out[s:dst] * (n//dist + 1))[:n]
+        dst += n
+  except IndexError:
+    raise ValueError("Truncated Yaz0 data.") from None
+  return bytes(out)
+
+
+def common_length(data:bytes, a:int, b:int, max_length:int, known:int=0) -> int:
+  """
+  length of the common prefix of data[a:] and data[b:] (up to max_length), known : length already equal
+  The length is doubled while it matches, then searched by bisection.
+  """
+  lo, hi = known, max(known*2, 4)
+  while hi < max_length and data[a:a+hi] == data[b:b+hi]:
+    lo, hi = hi, hi*2
+  hi = min(hi, max_length)
+  if data[a:a+hi] == data[b:b+hi]:
+    return hi
+  while hi - lo > 1:
+    mid = (lo + hi) // 2
+    if data[a:a+mid] == data[b:b+mid]:
+      lo = mid
+    else:
+      hi = mid
+  return lo
+
+
+def yaz0_chains(data:bytes) -> tuple:
+  """
+  -> (previous position starting with the same 3 bytes, -1 : none,
+      next position which has one in the window, len(data) : none) per position
+  """
+  import numpy as np
+  d = np.frombuffer(data, np.uint8).astype(np.int32)
+  prev = np.full(len(d), -1, np.int64)
+  if len(d) >= 3:
+    keys = d[:-2] << 16 | d[1:-1] << 8 | d[2:]
+    order = np.argsort(keys, kind="stable")
+    same = keys[order[1:]] == keys[order[:-1]]
+    prev[order[1:][same]] = order[:-1][same]
+  pos = np.arange(len(d))
+  found = np.flatnonzero((prev >= 0) & (pos - prev <= YAZ0_WINDOW))
+  following = np.append(found, len(d))[np.searchsorted(found, pos)]
+  return prev.tolist(), following.tolist()
+
+
+def yaz0_compress(data, level:int=1) -> bytes:
+  """
+  bytes -> Yaz0
+  level 0 : no back reference (fast, 1/8 larger than data)
+  level 1 : greedy matching, the longest of the YAZ0_CHAIN nearest positions starting with the same 3 bytes
+  Runs of positions without any candidate are written as whole literal groups (numpy).
+  """
+  data = bytes(data)
+  size = len(data)
+  out = bytearray(YAZ0_HEADER.pack(b"Yaz0", size))
+  if level == 0:
+    return bytes(out + literal_groups(data))
+
+  prev, following = yaz0_chains(data)
+  head, bit = 0, 8 # header byte of the current group, chunks written in it
+  pos = 0
+  while pos < size:
+    # whole groups of literals up to the next position with a candidate
+    n = following[pos] - pos
+    if n >= 8 and bit == 8:
+      out += literal_groups(data[pos:pos+n//8*8])
+      pos += n//8*8
+      continue
+
+    best, best_pos = 0, 0
+    if n == 0:
+      max_length = min(YAZ0_MAX_LENGTH, size-pos)
+      candidate, tries = prev[pos], 0
+      while candidate >= 0 and pos-candidate <= YAZ0_WINDOW and tries < YAZ0_CHAIN:
+        # the 3 first bytes are equal, a longer match also has the best first ones
+        if best < 3 or data[candidate:candidate+best+1] == data[pos:pos+best+1]:
+          length = common_length(data, candidate, pos, max_length, max(best+1, 3))
+          if length > best:
+            best, best_pos = length, candidate
+            if best >= max_length:
+              break
+        candidate, tries = prev[candidate], tries+1
+
+    if bit == 8:
+      head, bit = len(out), 0
+      out.append(0)
+    if best < 3:
+      out[head] |= 0x80 >> bit
+      out.append(data[pos])
+      pos += 1
+    else:
+      dist = pos - best_pos - 1
+      if best >= 0x12:
+        out += bytes((dist >> 8, dist & 0xFF, best-0x12))
+      else:
+        out += bytes(((best-2) << 4 | dist >> 8, dist & 0xFF))
+      pos += best
+    bit += 1
+  return bytes(out)
+
+
+def literal_groups(data:bytes) -> bytes:
+  """
+  bytes -> Yaz0 groups of 8 literals (0xFF header), the last one may be shorter
+  """
+  import numpy as np
+  full = len(data)//8*8
+  groups = np.empty((full//8, 9), np.uint8)
+  groups[:, 0] = 0xFF
+  groups[:, 1:] = np.frombuffer(data, np.uint8, full).reshape(-1, 8)
+  tail = data[full:]
+  return groups.tobytes() + (b"\xFF" + tail if len(tail) > 0 else b"")
+
+
+class U8Archive(object):
+  """
+  U8 archive (in memory), files are {path: (node index, data offset, size)}.
+  Paths are "/" joined node names ("./course.kmp").
+  """
+  def __init__(self, data):
+    self.data = bytes(data)
+    if len(self.data) < U8_HEADER.size or self.data[:4] != U8_MAGIC:
+      raise ValueError("Invalid U8 archive.")
+    _, self.root, header_size, self.data_offset = U8_HEADER.unpack_from(self.data)
+    count = U8_NODE.unpack_from(self.data, self.root)[2]
+    strings = self.root + count*U8_NODE.size
+    if strings > len(self.data):
+      raise ValueError("Invalid U8 archive.")
+
+    self.files = {}
+    dirs = [(count, "")] # (end node, path)
+    for i in range(count):
+      while len(dirs) > 1 and i >= dirs[-1][0]:
+        dirs.pop()
+      kind_name, offset, size = U8_NODE.unpack_from(self.data, self.root + i*U8_NODE.size)
+      name_start = strings + (kind_name & 0xFFFFFF)
+      name = self.data[name_start:self.data.index(b"\x00", name_start)].decode("utf-8", errors="replace")
+      path = name if dirs[-1][1] == "" else dirs[-1][1] + "/" + name
+      if kind_name >> 24 == 1:
+        if i > 0:
+          dirs.append((size, path))
+      else:
+        if offset + size > len(self.data):
+          raise ValueError(path + " exceeds the archive.")
+        self.files[path] = (i, offset, size)
+
+  def find(self, name:str, suffix:str=None) -> str:
+    """
+    file name (or single file ending with suffix) -> path
+    """
+    paths = [path for path in self.files if path.split("/")[-1] == name]
+    if len(paths) == 0 and suffix is not None:
+      paths = [path for path in self.files if path.endswith(suffix)]
+    if len(paths) != 1:
+      raise ValueError(name + (" not found." if len(paths) == 0 else " is not unique."))
+    return paths[0]
+
+  def read(self, path:str) -> bytes:
+    i, offset, size = self.files[path]
+    return self.data[offset:offset+size]
+
+  def replace(self, path:str, data:bytes) -> bytes:
+    """
+    -> archive bytes with the file replaced
+    The following files are moved by a multiple of 32 bytes (their alignment is kept).
+    """
+    i, offset, size = self.files[path]
+    grow = len(data) - size
+    delta = (grow + 31)//32*32 if grow > 0 else -(-grow//32*32)
+    out = bytearray(self.data[:offset])
+    out += data
+    out += bytes(size + delta - len(data))
+    out += self.data[offset+size:]
+    for j, x, n in self.files.values():
+      if x > offset or (x == offset and j > i):
+        pack_into(">I", out, self.root + j*U8_NODE.size + 4, x + delta)
+    pack_into(">I", out, self.root + i*U8_NODE.size + 8, len(data))
+    return bytes(out)
+
+
+def read_archive(source) -> tuple:
+  """
+  SZS or U8 (path or bytes) -> (U8Archive, Yaz0 compressed)
+  """
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    data = source
+  else:
+    with open(source, "rb") as f:
+      data = f.read()
+  compressed = is_yaz0(data)
+  return U8Archive(yaz0_decompress(data) if compressed else data), compressed
+
+
+def is_archive(source) -> bool:
+  """
+  path ending with .szs or bytes of a SZS / U8 archive
+  """
+  if isinstance(source, str):
+    return source.lower().endswith(".szs")
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    return is_yaz0(source) or bytes(source[:4]) == U8_MAGIC
+  return False
+
+
+def szs_kmp(source, name:str="course.kmp") -> bytes:
+  """
+  SZS (path or bytes) -> KMP bytes
+  """
+  archive, _ = read_archive(source)
+  return archive.read(archive.find(name, ".kmp"))
+
+
+def replace_kmp(source, kmp:bytes, name:str="course.kmp", level:int=1) -> bytes:
+  """
+  SZS (path or bytes), KMP -> SZS bytes with only the KMP replaced (compressed again if it was)
+  """
+  archive, compressed = read_archive(source)
+  data = archive.replace(archive.find(name, ".kmp"), kmp)
+  return yaz0_compress(data, level) if compressed else data
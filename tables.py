@@ -0,0 +1,239 @@
+import json
+import os
+from io import BytesIO
+
+import profiling
+
+try:
+  from python_calamine import CalamineWorkbook
+except ImportError:
+  CalamineWorkbook = None
+
+
+# xlsx is one workbook, the others are a directory of one file per sheet (<sheet>.<format>).
+FORMATS = ["xlsx", "parquet", "feather", "csv", "ndjson"]
+
+# A table is {column name: np.ndarray}, one per sheet.
+# Empty cells are NaN, numeric columns are float64 and other columns are object arrays.
+
+def to_column(values:list):
+  import numpy as np
+  values = [np.nan if x is None or x == "" else x for x in values]
+  try:
+    return np.array(values, dtype=np.float64)
+  except (TypeError, ValueError):
+    return np.array(values, dtype=object)
+
+
+def table_length(table:dict) -> int:
+  return len(next(iter(table.values()))) if len(table) > 0 else 0
+
+
+def rows_to_table(rows) -> dict:
+  """
+  rows (header first) -> table
+  Columns without header (DataFrame index) and empty rows are dropped.
+  """
+  rows = iter(rows)
+  header = next(rows, [])
+  keep = [i for i, x in enumerate(header) if x is not None and x != ""]
+  data = [[] for i in keep]
+  for row in rows:
+    if all(x is None or x == "" for x in row):
+      continue
+    row = list(row) + [None]*(len(header)-len(row))
+    for values, i in zip(data, keep):
+      values.append(row[i])
+  return {str(header[i]): to_column(values) for i, values in zip(keep, data)}
+
+
+def source_size(source) -> int:
+  """
+  path, bytes or file-like object -> size in bytes (0 if unknown)
+  """
+  if isinstance(source, (bytes, bytearray, memoryview)):
+    return len(source)
+  if hasattr(source, "getbuffer"):
+    return source.getbuffer().nbytes
+  if hasattr(source, "read"):
+    return 0
+  return os.path.getsize(source)
+
+
+def excel_engine(engine:str=None) -> str:
+  """
+  None -> calamine if installed, else openpyxl
+  """
+  if engine is None:
+    return "openpyxl" if CalamineWorkbook is None else "calamine"
+  if engine not in ["openpyxl", "calamine"]:
+    raise ValueError("Unknown engine: " + engine)
+  if engine == "calamine" and CalamineWorkbook is None:
+    raise ImportError("python-calamine is not installed.")
+  return engine
+
+
+def write_excel(frames, dest, widths:dict={}):
+  """
+  (sheet, DataFrame) -> xlsx, each sheet is streamed as soon as it is given (write-only workbook).
+  dest : path or binary file-like object
+  widths : {sheet: column letter or [column letters]} set to 15
+  Layout is the same as DataFrame.to_excel (index column, bold header).
+  """
+  from openpyxl import Workbook
+  from openpyxl.cell import WriteOnlyCell
+  from openpyxl.styles import Alignment, Border, Font, Side
+
+  side = Side(style="thin")
+  border = Border(left=side, right=side, top=side, bottom=side)
+  font = Font(bold=True)
+  alignment = Alignment(horizontal="center", vertical="top")
+
+  def header_cell(worksheet, value):
+    cell = WriteOnlyCell(worksheet, value=value)
+    cell.font, cell.border, cell.alignment = font, border, alignment
+    return cell
+
+  workbook = Workbook(write_only=True)
+  for sheet, df in frames:
+    with profiling.phase("excel_write", sheet):
+      worksheet = workbook.create_sheet(sheet)
+      expand = widths.get(sheet, [])
+      for clms in [expand] if isinstance(expand, str) else expand:
+        worksheet.column_dimensions[clms].width = 15
+
+      worksheet.append([None] + [header_cell(worksheet, str(clm)) for clm in df.columns])
+      columns = [df[clm].tolist() for clm in df.columns]
+      for i, row in enumerate(zip(*columns)):
+        worksheet.append([header_cell(worksheet, i)] + [None if x != x else x for x in row])
+      del df, columns
+  with profiling.phase("excel_save"):
+    workbook.save(dest)
+    profiling.count("write", source_size(dest))
+
+
+def iter_excel(path, sheets:list, engine:str=None):
+  """
+  Open the workbook once and yield (sheet, table) in order of sheets.
+  path : path, bytes or binary file-like object
+  """
+  engine = excel_engine(engine)
+  if isinstance(path, (bytes, bytearray, memoryview)):
+    path = BytesIO(path)
+  with profiling.phase("excel_open"):
+    profiling.count("read", source_size(path))
+    if engine == "calamine":
+      workbook = CalamineWorkbook.from_object(path)
+    else:
+      from openpyxl import load_workbook
+      workbook = load_workbook(path, read_only=True, data_only=True)
+  try:
+    for sheet in sheets:
+      with profiling.phase("excel_read", sheet):
+        if engine == "calamine":
+          table = rows_to_table(workbook.get_sheet_by_name(sheet).to_python())
+        else:
+          table = rows_to_table(workbook[sheet].iter_rows(values_only=True))
+      yield sheet, table
+  finally:
+    if engine != "calamine":
+      workbook.close()
+
+
+def frame_to_table(df) -> dict:
+  import numpy as np
+  table = {}
+  for clm in df.columns:
+    if df[clm].dtype.kind in "biuf":
+      table[str(clm)] = df[clm].to_numpy(np.float64)
+    else:
+      table[str(clm)] = to_column(df[clm].tolist())
+  return table
+
+
+def is_tables_dir(path:str) -> bool:
+  return os.path.isdir(path) and any(
+      os.path.splitext(name)[1][1:] in FORMATS[1:] for name in os.listdir(path))
+
+
+def table_format(path:str) -> str:
+  """
+  path -> format
+  """
+  if is_tables_dir(path):
+    for name in sorted(os.listdir(path)):
+      fmt = os.path.splitext(name)[1][1:]
+      if fmt in FORMATS[1:]:
+        return fmt
+  fmt = os.path.splitext(path)[1][1:]
+  if fmt in FORMATS:
+    return fmt
+  raise ValueError("Unknown format: " + path)
+
+
+def read_table(path:str, fmt:str) -> dict:
+  if fmt == "csv":
+    import csv
+    with open(path, newline="", encoding="utf-8") as f:
+      return rows_to_table(csv.reader(f))
+  if fmt == "ndjson":
+    with open(path, encoding="utf-8") as f:
+      header = json.loads(f.readline())
+      rows = [header] + [json.loads(line) for line in f if line.strip()]
+    return rows_to_table(rows)
+  import pandas as pd
+  if fmt == "parquet":
+    return frame_to_table(pd.read_parquet(path))
+  if fmt == "feather":
+    return frame_to_table(pd.read_feather(path))
+  raise ValueError("Unknown format: " + fmt)
+
+
+def write_frame(df, path:str, fmt:str):
+  if fmt == "parquet":
+    df.to_parquet(path, index=False)
+  elif fmt == "feather":
+    df.reset_index(drop=True).to_feather(path)
+  elif fmt == "csv":
+    df.to_csv(path, index=False)
+  elif fmt == "ndjson":
+    # first line is the header (keeps column order of empty sheets)
+    with open(path, "w", encoding="utf-8") as f:
+      f.write(json.dumps([str(clm) for clm in df.columns]) + "\n")
+      for row in df.itertuples(index=False):
+        f.write(json.dumps([None if x != x else x for x in map(to_json, row)]) + "\n")
+  else:
+    raise ValueError("Unknown format: " + fmt)
+
+
+def to_json(value):
+  import numpy as np
+  return value.item() if isinstance(value, np.generic) else value
+
+
+def write_frames(frames, dest:str, fmt:str):
+  """
+  (sheet, DataFrame) -> dest/<sheet>.<fmt>
+  """
+  os.makedirs(dest, exist_ok=True)
+  for sheet, df in frames:
+    with profiling.phase("table_write", sheet):
+      write_frame(df, os.path.join(dest, sheet + "." + fmt), fmt)
+      profiling.count("write", os.path.getsize(os.path.join(dest, sheet + "." + fmt)))
+
+
+def iter_tables(path, sheets:list, fmt:str=None, engine:str=None):
+  """
+  yield (sheet, table) in order of sheets from any format
+  path : path (xlsx : also bytes or binary file-like object)
+  """
+  if fmt is None:
+    fmt = "xlsx" if not isinstance(path, str) else table_format(path)
+  if fmt == "xlsx":
+    yield from iter_excel(path, sheets, engine)
+    return
+  for sheet in sheets:
+    with profiling.phase("table_read", sheet):
+      profiling.count("read", os.path.getsize(os.path.join(path, sheet + "." + fmt)))
+      table = read_table(os.path.join(path, sheet + "." + fmt), fmt)
+    yield sheet, table
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from szs import U8_HEADER, U8_MAGIC, U8_NODE, U8Archive, replace_kmp, szs_kmp, yaz0_compress, yaz0_decompress
+
+
+def build_u8(files:dict) -> bytes:
+  """
+  {name: bytes} -> U8 archive holding ./<name> (data aligned to 32 bytes)
+  """
+  names = ["", "."] + list(files)
+  strings = bytearray()
+  offsets = []
+  for name in names:
+    offsets.append(len(strings))
+    strings += name.encode("utf-8") + b"\x00"
+  root = U8_HEADER.size + 16
+  count = len(names)
+  header_size = count*U8_NODE.size + len(strings)
+  data_offset = (root + header_size + 31)//32*32
+  data = bytearray()
+  nodes = [(1 << 24 | offsets[0], 0, count), (1 << 24 | offsets[1], 0, count)]
+  for i, content in enumerate(files.values()):
+    nodes.append((offsets[i+2], data_offset + len(data), len(content)))
+    data += content + bytes(-len(content) % 32)
+  out = U8_HEADER.pack(U8_MAGIC, root, header_size, data_offset) + b"\xCC"*16
+  out += b"".join([U8_NODE.pack(*x) for x in nodes]) + bytes(strings)
+  return out + bytes(data_offset - len(out)) + bytes(data)
+
+
+def course_files(seed:int=0) -> dict:
+  rng = random.Random(seed)
+  model = b"".join([b"vertex %d %d %d\n" % (i % 97, i % 13, i) for i in range(2000)])
+  return {
+      "course.kmp": b"RKMD" + bytes([rng.randrange(256) for _ in range(5000)]),
+      "course_model.brres": model + bytes(3000) + model[::3],
+      "empty.bin": b""}
+
+
+@pytest.mark.parametrize("level", [0, 1])
+def test_yaz0_u8_roundtrip(level):
+  files = course_files()
+  archive = build_u8(files)
+  data = yaz0_compress(archive, level)
+  assert yaz0_decompress(data) == archive
+  if level == 1:
+    assert len(data) < len(archive)
+  u8 = U8Archive(yaz0_decompress(data))
+  assert {path: u8.read(path) for path in u8.files} == {"./" + name: x for name, x in files.items()}
+
+
+def test_replace_kmp_roundtrip():
+  files = course_files()
+  szs = yaz0_compress(build_u8(files))
+  kmp = b"RKMD" + bytes(range(256))*30
+  replaced = replace_kmp(szs, kmp)
+  assert szs_kmp(replaced) == kmp
+  u8 = U8Archive(yaz0_decompress(replaced))
+  assert u8.read("./course_model.brres") == files["course_model.brres"]
+  assert u8.read("./empty.bin") == b""
+
+
+@pytest.mark.parametrize("data", [
+    b"", b"a", b"abc", bytes(5000), b"abc"*3000, bytes(range(256))*20,
+    bytes([random.Random(1).randrange(4) for _ in range(20000)])])
+def test_yaz0_roundtrip(data):
+  for level in [0, 1]:
+    assert yaz0_decompress(yaz0_compress(data, level)) == data
@@ -0,0 +1,311 @@
+import time
+
+import profiling
+from routes import NO_LINK, PathGraph, excel_row
+from schema import PATH_SHEETS, POTI_ROUTE, RECORDS, SHEETS, XPF_OBJECTS, XPF_PRESENCE
+from tables import frame_to_table, iter_tables, table_length
+
+
+# cross references : (sheet, column, target sheet, target, "no link" value or None, types or None)
+# a route is a POTI group, the other targets are rows of the target sheet
+# types : values of the Type column which use the link (None : every row), the byte is left as it is by the
+# other types (retail courses keep old values there), a missing target is only a warning on those rows
+LINKS = [
+    ("CKPT+CKPH", "Respawn", "JGPT", "respawn point", NO_LINK, None),
+    ("GOBJ", "Route", "POTI", "route", 0xFFFF, None),
+    ("AREA", "Camera", "CAME", "camera", NO_LINK, {0}),         # camera
+    ("AREA", "Route", "POTI", "route", NO_LINK, {3}),           # moving road
+    ("AREA", "Enemy", "ENPT+ENPH", "enemy point", NO_LINK, {4}), # force recalculation
+    ("CAME", "Next", "CAME", "camera", NO_LINK, {5, 6}),        # opening cameras
+    ("CAME", "Route", "POTI", "route", NO_LINK, {2, 4, 6}),     # path cameras
+    ]
+
+# start and length of a path group are bytes
+MAX_GROUP_POINT = 255
+
+# columns older workbooks may not have (CKPT links are derived from the groups)
+OPTIONAL_COLUMNS = {"CKPT+CKPH": ["Prev", "Next"]}
+
+
+def problem(sheet:str, column:str, message:str, row:int=None, level:str="error") -> dict:
+  """
+  level : "error" (the tables are not encoded) or "warning"
+  """
+  return {"sheet": sheet, "row": row, "column": column, "message": message, "level": level}
+
+
+def errors(problems:list) -> list:
+  return [p for p in problems if p["level"] == "error"]
+
+
+def format_problem(p:dict) -> str:
+  text = ("warning: " if p["level"] == "warning" else "") + p["sheet"] + ":"
+  if p["column"] is not None:
+    text += f" '{p['column']}'"
+  if p["row"] is not None:
+    text += f" row {p['row']}"
+  return text + " " + p["message"] + "."
+
+
+def cell(x) -> str:
+  return str(int(x)) if float(x).is_integer() else str(x)
+
+
+def column_limits(sheet:str) -> dict:
+  """
+  sheet -> {column: (min, max) of an integer column or None (float, group ID, reference)}
+  """
+  import numpy as np
+  records = [RECORDS[x] for x in PATH_SHEETS.get(sheet, [sheet]) if x in RECORDS]
+  if sheet == "POTI":
+    records.append(POTI_ROUTE)
+  limits = {clm: None for clm in SHEETS[sheet]}
+  for record in records:
+    for clm in record.columns:
+      if record.dtype[clm].kind in "iu":
+        info = np.iinfo(record.dtype[clm])
+        limits[clm] = (int(info.min), int(info.max))
+  if sheet == "GOBJ":
+    for clm, shift, bits in XPF_OBJECTS + XPF_PRESENCE:
+      limits[clm] = (0, (1 << bits) - 1)
+  if sheet == "CAME":
+    limits["First1"] = limits["First2"] = (0, 1)
+  return limits
+
+
+def numeric_column(sheet:str, column:str, values, problems:list) -> tuple:
+  """
+  column -> (float64 values, bool per row not a number), text cells are reported
+  """
+  import numpy as np
+  values = np.asarray(values)
+  if values.dtype.kind in "biuf":
+    values = values.astype(np.float64)
+    return values, np.zeros(len(values), bool)
+  result = np.full(len(values), np.nan)
+  wrong = np.zeros(len(values), bool)
+  for i, x in enumerate(values.tolist()):
+    try:
+      result[i] = np.nan if x is None or x == "" else float(x)
+    except (TypeError, ValueError):
+      wrong[i] = True
+      problems.append(problem(sheet, column, f"is not a number ({x})", excel_row(i)))
+  return result, wrong
+
+
+def check_column(sheet:str, column:str, values, limits:tuple, rows, problems:list) -> tuple:
+  """
+  Report the type, empty cells and range of a column.
+  limits : (min, max) of an integer column, None : any number
+  rows : None (a value on every row), bool per row (a value on these rows, empty on the others : groups)
+         or False (empty cells allowed)
+  -> (float64 values, bool per row holding a valid value)
+  """
+  import numpy as np
+  values, wrong = numeric_column(sheet, column, values, problems)
+  empty = np.isnan(values) & ~wrong
+  bad = []
+  if rows is None:
+    bad.append((empty, "is empty"))
+  elif rows is not False:
+    bad.append((empty & rows, "is empty (first row of a group)"))
+    bad.append((~empty & ~wrong & ~rows, "is ignored (not the first row of a group), leave it empty"))
+  valid = ~empty & ~wrong
+  if rows is not None and rows is not False:
+    valid &= rows
+  if limits is not None:
+    lo, hi = limits
+    with np.errstate(invalid="ignore"):
+      fraction = valid & (values != np.floor(values))
+      outside = valid & ~fraction & ((values < lo) | (values > hi))
+    bad.append((fraction, "is not an integer ({})"))
+    bad.append((outside, f"is out of range ({{}}, {lo} to {hi})"))
+    valid &= ~fraction & ~outside
+  for mask, message in bad:
+    for i in np.flatnonzero(mask):
+      problems.append(problem(sheet, column, message.format(cell(values[i])), excel_row(i)))
+  return values, valid
+
+
+def check_references(sheet:str, values, problems:list):
+  """
+  Report the GOBJ "Reference (hex)" cells which are not a uint16 (hex or decimal text).
+  """
+  for i, x in enumerate(list(values)):
+    if x is None or x != x or x == "":
+      problems.append(problem(sheet, "Reference (hex)", "is empty", excel_row(i)))
+      continue
+    try:
+      value = int(str(x), 0)
+    except ValueError:
+      value = None
+    if value is None or not 0 <= value <= 0xFFFF:
+      problems.append(problem(sheet, "Reference (hex)", f"is not a uint16 ({x})", excel_row(i)))
+
+
+def group_starts(sheet:str, column:str, values, problems:list):
+  """
+  group ID column -> bool per row starting a group (row 2 always starts one)
+  """
+  import numpy as np
+  values, wrong = numeric_column(sheet, column, values, problems)
+  firsts = ~np.isnan(values) | wrong
+  if len(firsts) > 0 and not firsts[0]:
+    problems.append(problem(sheet, column, "must start a group (ID is empty)", excel_row(0)))
+    firsts[0] = True
+  return firsts
+
+
+def check_sheet(sheet:str, table:dict, problems:list) -> tuple:
+  """
+  -> ({column: (float64 values, bool per valid row)}, PathGraph of the groups or None)
+  """
+  import numpy as np
+  optional = OPTIONAL_COLUMNS.get(sheet, [])
+  missing = [clm for clm in SHEETS[sheet] if clm not in table and clm not in optional]
+  for clm in missing:
+    problems.append(problem(sheet, clm, "is missing"))
+  if len(missing) > 0:
+    return {}, None
+
+  rows, graph = {}, None
+  pt, ph = PATH_SHEETS.get(sheet, (sheet, None))
+  if sheet in PATH_SHEETS or sheet == "POTI":
+    id_column = "ID" if ph is None else ph + " ID"
+    firsts = group_starts(sheet, id_column, table[id_column], problems)
+    starts = np.flatnonzero(firsts)
+    graph = PathGraph(starts, np.diff(np.append(starts, len(firsts))), len(firsts))
+    group_columns = POTI_ROUTE.columns if ph is None else RECORDS[ph].columns
+    rows = {clm: firsts for clm in group_columns}
+    rows[id_column] = False
+    if ph is not None:
+      for i in np.flatnonzero((graph.starts > MAX_GROUP_POINT) | (graph.lengths > MAX_GROUP_POINT)):
+        problems.append(problem(
+            sheet, id_column, f"starts a group of {graph.lengths[i]} points at point {graph.starts[i]} "
+            f"(both must be at most {MAX_GROUP_POINT})", excel_row(graph.starts[i])))
+  if pt == "CKPT":
+    rows["Prev"] = rows["Next"] = False
+  if sheet == "CAME":
+    rows["First1"] = rows["First2"] = False
+
+  columns = {}
+  for clm, limits in column_limits(sheet).items():
+    if clm not in table:
+      continue
+    if clm == "Reference (hex)":
+      check_references(sheet, table[clm], problems)
+      continue
+    columns[clm] = check_column(sheet, clm, table[clm], limits, rows.get(clm), problems)
+
+  if ph is not None:
+    for clm in [x for x in RECORDS[ph].columns if x.startswith(("Last ", "Next "))]:
+      values, valid = columns[clm]
+      starts = graph.starts[valid[graph.starts] & graph.missing_groups(values[graph.starts])]
+      for i in starts:
+        problems.append(problem(sheet, clm, f"refers to a missing group ({cell(values[i])})", excel_row(i)))
+    if pt == "CKPT":
+      for clm in [x for x in ["Prev", "Next"] if x in columns]:
+        values, valid = columns[clm]
+        for i in np.flatnonzero(valid & graph.missing_points(values)):
+          problems.append(problem(sheet, clm, f"refers to a missing point ({cell(values[i])})", excel_row(i)))
+
+  if sheet == "CAME" and table_length(table) > 0:
+    for clm in ["First1", "First2"]:
+      values, valid = columns[clm]
+      flagged = np.flatnonzero(valid & (values == 1))
+      if len(flagged) != 1:
+        found = "none" if len(flagged) == 0 else "rows " + ", ".join([str(excel_row(i)) for i in flagged])
+        problems.append(problem(sheet, clm, f"must be 1 on exactly one row ({found})"))
+  return columns, graph
+
+
+def validate_tables(tables) -> list:
+  """
+  {sheet name: DataFrame or table} (or (sheet, table) pairs) -> [problem] (no error : the tables can be encoded)
+  Every column is checked at once : types, empty cells, integer ranges, path group links and cross references
+  (routes, cameras, enemy and respawn points).
+  problem : {"sheet", "row" (Excel row or None), "column", "message", "level"}
+  """
+  import numpy as np
+  if hasattr(tables, "items"):
+    tables = tables.items()
+  problems, columns, counts = [], {}, {}
+  with profiling.phase("validate"):
+    for sheet, table in tables:
+      if not isinstance(table, dict):
+        table = frame_to_table(table)
+      if sheet not in SHEETS:
+        problems.append(problem(sheet, None, "is not a KMP sheet"))
+        continue
+      columns[sheet], graph = check_sheet(sheet, table, problems)
+      counts[sheet] = graph.groups if sheet == "POTI" and graph is not None else table_length(table)
+
+    for sheet, clm, target_sheet, target, no_link, types in LINKS:
+      if clm not in columns.get(sheet, {}) or target_sheet not in counts:
+        continue
+      values, valid = columns[sheet][clm]
+      bad = valid & ((values < 0) | (values >= counts[target_sheet]))
+      if no_link is not None:
+        bad &= values != no_link
+      kinds = columns[sheet]["Type"][0] if types is not None else None
+      for i in np.flatnonzero(bad):
+        if types is None or kinds[i] in types:
+          problems.append(problem(sheet, clm, f"refers to a missing {target} ({cell(values[i])})", excel_row(i)))
+        else:
+          problems.append(problem(
+              sheet, clm, f"refers to a missing {target} ({cell(values[i])}, unused by type {cell(kinds[i])})",
+              excel_row(i), "warning"))
+  return problems
+
+
+def check_tables(tables):
+  """
+  Raise ValueError listing every error of the tables (before anything is encoded), warnings are ignored.
+  """
+  problems = errors(validate_tables(tables))
+  if len(problems) > 0:
+    raise ValueError(f"{len(problems)} problems found:\n" + "\n".join(["  " + format_problem(p) for p in problems]))
+
+
+def validate_file(path, fmt:str=None, engine:str=None) -> tuple:
+  """
+  -> (path, [problem], error or None, seconds)
+  """
+  start = time.perf_counter()
+  try:
+    problems, error = validate_tables(iter_tables(path, list(SHEETS.keys()), fmt, engine)), None
+  except Exception as e:
+    problems, error = [], type(e).__name__ + ": " + str(e)
+  return path, problems, error, time.perf_counter()-start
+
+
+def validate_files(paths:list, jobs:int=1, fmt:str=None, engine:str=None) -> int:
+  """
+  Validate each Excel file (or tables directory) and print its problems.
+  -> number of files which failed
+  """
+  start = time.perf_counter()
+  if jobs <= 1:
+    results = (validate_file(path, fmt, engine) for path in paths)
+  else:
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    results = pool.map(validate_file, paths, [fmt]*len(paths), [engine]*len(paths))
+  failed = 0
+  for path, problems, error, seconds in results:
+    if error is not None:
+      print(f"{path} : FAILED ({error})")
+    elif len(errors(problems)) > 0:
+      print(f"{path} : {len(errors(problems))} problems")
+      for p in problems:
+        print("  " + format_problem(p))
+    else:
+      warnings = "" if len(problems) == 0 else f", {len(problems)} warnings"
+      print(f"{path} : OK ({seconds:.2f}s{warnings})")
+      for p in problems:
+        print("  " + format_problem(p))
+    failed += error is not None or len(errors(problems)) > 0
+  if jobs > 1:
+    pool.shutdown()
+  print(f"{len(paths)-failed} valid, {failed} failed ({time.perf_counter()-start:.2f}s)")
+  return failed
@@ -0,0 +1,143 @@
+import time
+
+from kmpfile import KmpFile
+
+
+def difference(section:str, message:str, entry:int=None, field:str=None, expected=None, actual=None) -> dict:
+  return {
+      "section": section, "entry": entry, "field": field,
+      "expected": expected, "actual": actual, "message": message}
+
+
+def compare_arrays(section:str, expected, actual, rtol:float=0.0, atol:float=0.0):
+  """
+  structured arrays -> difference of the first differing entry (None if equal)
+  Floats are equal within rtol/atol (NaN equals NaN), the other fields (and floats without tolerance)
+  must be identical.
+  """
+  import numpy as np
+  if len(expected) != len(actual):
+    return difference(section, "entry count differs", expected=len(expected), actual=len(actual))
+  first = None
+  for key in expected.dtype.names:
+    x, y = expected[key], actual[key]
+    if x.dtype.kind == "f" and (rtol > 0 or atol > 0):
+      same = np.isclose(x, y, rtol=rtol, atol=atol, equal_nan=True)
+    elif x.dtype.kind == "f":
+      same = np.ascontiguousarray(x).view(">u4") == np.ascontiguousarray(y).view(">u4")
+    else:
+      same = x == y
+    if not same.all():
+      i = int(np.argmin(same))
+      if first is None or i < first["entry"]:
+        first = difference(section, "field differs", i, key, x[i].item(), y[i].item())
+  return first
+
+
+def compare_kmp(expected, actual, rtol:float=0.0, atol:float=0.0) -> list:
+  """
+  KMP, KMP (path or bytes) -> [difference per differing section (first entry and field)]
+  Sections are located with the offset tables and compared independently,
+  identical bytes are not decoded.
+  """
+  result = []
+  with KmpFile(expected) as a, KmpFile(actual) as b:
+    if a.version != b.version:
+      result.append(difference("header", "version differs", expected=a.version, actual=b.version))
+    if a.keys() != b.keys():
+      result.append(difference("header", "sections differ", expected=a.keys(), actual=b.keys()))
+    for x in a:
+      if x.name not in b:
+        continue
+      y = b[x.name]
+      if a.parser.buffer[x.head:x.end] == b.parser.buffer[y.head:y.end]:
+        continue
+      if x.option != y.option:
+        result.append(difference(x.name, "header option differs", expected=x.option, actual=y.option))
+        continue
+      if x.entry != y.entry:
+        result.append(difference(x.name, "entry count differs", expected=x.entry, actual=y.entry))
+        continue
+      diff = None
+      if x.name == "POTI":
+        diff = compare_arrays("POTI routes", x.routes, y.routes)
+      if diff is None:
+        diff = compare_arrays(x.name, x.array, y.array, rtol, atol)
+      if diff is None and x.nbytes != y.nbytes:
+        diff = difference(x.name, "section size differs", expected=x.nbytes, actual=y.nbytes)
+      if diff is not None:
+        result.append(diff)
+  return result
+
+
+def roundtrip(source, excel:bool=False, engine:str=None) -> bytes:
+  """
+  KMP -> tables (or xlsx) -> KMP bytes, in memory
+  The tables are not validated : dangling links of the KMP must come back as they are.
+  """
+  from k2x import kmp_to_tables, kmp_to_xlsx_bytes
+  from x2k import excel_to_kmp, tables_to_kmp
+  if excel:
+    return excel_to_kmp(kmp_to_xlsx_bytes(source), engine, validate=False)
+  return tables_to_kmp(kmp_to_tables(source), validate=False)
+
+
+def verify(source, rtol:float=0.0, atol:float=0.0, excel:bool=False, engine:str=None) -> list:
+  """
+  KMP (path or bytes) -> [difference] between the KMP and its round trip ([] : verified)
+  """
+  if not isinstance(source, (bytes, bytearray, memoryview)):
+    with open(source, "rb") as f:
+      source = f.read()
+  return compare_kmp(source, roundtrip(source, excel, engine), rtol, atol)
+
+
+def verify_file(path:str, *args) -> tuple:
+  """
+  -> (path, [difference], error or None, seconds)
+  """
+  start = time.perf_counter()
+  try:
+    diffs, error = verify(path, *args), None
+  except Exception as e:
+    diffs, error = [], type(e).__name__ + ": " + str(e)
+  return path, diffs, error, time.perf_counter()-start
+
+
+def format_difference(diff:dict) -> str:
+  text = diff["section"] + " : " + diff["message"]
+  if diff["entry"] is not None:
+    text += f" at entry {diff['entry']}, '{diff['field']}'"
+  if diff["expected"] is not None or diff["actual"] is not None:
+    text += f" ({diff['expected']} -> {diff['actual']})"
+  return text
+
+
+def verify_files(paths:list, jobs:int=1, rtol:float=0.0, atol:float=0.0, excel:bool=False, engine:str=None) -> int:
+  """
+  Verify each KMP and print the result.
+  -> number of files which failed
+  """
+  start = time.perf_counter()
+  args = (rtol, atol, excel, engine)
+  if jobs <= 1:
+    results = (verify_file(path, *args) for path in paths)
+  else:
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(max_workers=jobs)
+    results = pool.map(verify_file, paths, *[[x]*len(paths) for x in args])
+  failed = 0
+  for path, diffs, error, seconds in results:
+    if error is not None:
+      print(f"{path} : FAILED ({error})")
+    elif len(diffs) > 0:
+      print(f"{path} : {len(diffs)} sections differ")
+      for diff in diffs:
+        print("  " + format_difference(diff))
+    else:
+      print(f"{path} : OK ({seconds:.2f}s)")
+    failed += error is not None or len(diffs) > 0
+  if jobs > 1:
+    pool.shutdown()
+  print(f"{len(paths)-failed} verified, {failed} failed ({time.perf_counter()-start:.2f}s)")
+  return failed
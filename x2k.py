@@ -1,196 +1,355 @@
 import argparse
 import os
-
-import pandas as pd
-
-from binfunc import BinaryWriter
-
-
-def get_idx(df_list, df_index):
-  idx_1 = [idx for idx, x in enumerate(df_list) if not x] + [len(list(df_index))]
-  idx_2 = [idx_1[i+1]-idx_1[i] for i in range(len(idx_1)-1)]
-
-  return idx_1, idx_2
-
-
-def pt_ph_writer(writer:BinaryWriter, df:pd.DataFrame, sections:list, sect_id:int, target:str):
-  writer.write_string(target.split(" ")[0].replace("H", "T"))
-  writer.write_uint16_s([len(df.index), 0])
-
-  idx_1, idx_2 = get_idx(df[target].isnull(), df.index)
-
-  ph_data = []
-  ph_section = idx_1[:-1]
-
-  if sect_id == 2:
-    write_next_ids = [255, 1]
-
-  for i in df.index:
-    data = df.iloc[i].tolist()
-    writer.write_float_s(data[:4])
-    if sect_id == 0:
-      ph_st, ph_end = 8, 22
-      writer.write_uint16(data[4])
-      writer.write_byte_s(data[5:7])
-    else:
-      ph_st, ph_end = 7, 19
-      if sect_id == 2:
-        writer.write_byte_s(data[4:6])
-        writer.write_byte_s(write_next_ids)
-        if i in ph_section and i+1 in ph_section:
-          write_next_ids = [255, 255]
-        elif i+2==len(df.index) or i+2 in ph_section:
-          write_next_ids = [i, 255]
-        elif i+1 in ph_section:
-          write_next_ids = [255, i+2]
-        else:
-          write_next_ids = [i, i+2]
-      else:
-        writer.write_uint16_s(data[4:6])
-    if i in ph_section:
-      ph_data.append(data[ph_st:ph_end])
+import sys
+import time
+from itertools import accumulate
+from struct import pack
+
+import profiling
+from batch import expand_paths, is_batch, output_path, run_batch
+from binfunc import BinaryWriter, BufferWriter, MappedParser, encode_xpf
+from cache import Cache, file_digest, table_digest
+from client import forward
+from routes import path_columns
+from schema import FILE_HEADER, PATH_SHEETS, POTI_ROUTE, RECORDS, SECTION_HEADER, SHEETS, VERSION
+from szs import replace_kmp
+from tables import FORMATS, frame_to_table, is_tables_dir, iter_tables, table_length
+from validate import check_tables, validate_files
+
+
+def get_idx(ids) -> tuple:
+  """
+  Group ID column (empty except on the first row of each group) -> (first rows + [rows], group lengths)
+  """
+  import numpy as np
+  idx_1 = np.append(np.flatnonzero(~np.isnan(ids.astype(np.float64))), len(ids))
+  return idx_1.tolist(), np.diff(idx_1).tolist()
+
+
+def pt_ph_writer(writer:BinaryWriter, table:dict, sections:list, sheet:str):
+  pt, ph = PATH_SHEETS[sheet]
+  graph, points, paths = path_columns(table, sheet)
+
+  # ENPT, ITPT, CKPT
+  writer.write_string(pt)
+  writer.write_uint16_s([graph.points, 0])
+  writer.write_record(RECORDS[pt], points, graph.points)
 
   # ENPH, ITPH, CKPH
-  sections.append(writer.getaddress-76)
-  writer.write_string(target.split(" ")[0])
-  writer.write_uint16_s([len(idx_2), 0])
-  for i in range(len(ph_data)):
-    data = ph_data[i]
-    writer.write_byte_s([idx_1[i], idx_2[i]])
-    if sect_id == 0:
-      writer.write_byte_s(data[0:15])
+  sections.append(writer.getaddress)
+  writer.write_string(ph)
+  writer.write_uint16_s([graph.groups, 0])
+  writer.write_record(RECORDS[ph], paths, graph.groups)
+
+
+def object_writer(writer:BinaryWriter, table:dict):
+  count = table_length(table)
+  columns = dict(table)
+  columns["_objects"], columns["_presence"] = encode_xpf(table)
+  columns["_reference"] = [int(str(x), 0) for x in table["Reference (hex)"]]
+  writer.write_uint16_s([count, 0])
+  writer.write_record(RECORDS["GOBJ"], columns, count)
+
+
+def poti_writer(writer:BinaryWriter, table:dict):
+  import numpy as np
+  idx_1, idx_2 = get_idx(table["ID"])
+  starts, lengths = np.asarray(idx_1[:-1], np.int64), np.asarray(idx_2, np.int64)
+  routes, count = len(starts), int(lengths.sum())
+  header = {key: np.asarray(values)[starts] for key, values in table.items()}
+  header["_points"] = lengths
+  points = {key: np.asarray(values)[idx_1[0]:] for key, values in table.items()}
+
+  # all route headers and all points are encoded at once, then each header is put before its points
+  route_size, point_size = POTI_ROUTE.size, RECORDS["POTI"].size
+  header_at = np.arange(routes)*route_size + (np.cumsum(lengths) - lengths)*point_size
+  point_at = (np.repeat(np.arange(routes), lengths) + 1)*route_size + np.arange(count)*point_size
+  data = np.zeros(routes*route_size + count*point_size, np.uint8)
+  data[header_at[:, None] + np.arange(route_size)] = \
+      np.frombuffer(POTI_ROUTE.encode(header, routes), np.uint8).reshape(-1, route_size)
+  data[point_at[:, None] + np.arange(point_size)] = \
+      np.frombuffer(RECORDS["POTI"].encode(points, count), np.uint8).reshape(-1, point_size)
+
+  writer.write_uint16_s([routes, table_length(table)])
+  writer.write(data.tobytes())
+
+
+def came_writer(writer:BinaryWriter, table:dict):
+  writer.write_uint16(table_length(table))
+  # option 0 without cameras
+  for clm in ["First1", "First2"]:
+    writer.write_byte(table[clm].tolist().index(1) if table_length(table) > 0 else 0)
+  writer.write_record(RECORDS["CAME"], table, table_length(table))
+
+
+def other_writer(writer:BinaryWriter, table:dict, sheet:str):
+  import numpy as np
+  columns = dict(table)
+  if sheet == "STGI":
+    # float(single precision), but only 16-bit(MSB) is written
+    columns["_speed"] = np.asarray(table["Speed Factor"], np.float32).view(np.uint32) >> 16
+  writer.write_uint16_s([table_length(table), 0])
+  writer.write_record(RECORDS[sheet], columns, table_length(table))
+
+
+def encode_sheet(sheet:str, table:dict) -> list:
+  """
+  table -> [section bytes] (points and paths sheets give two sections)
+  """
+  writer = BufferWriter()
+  sections = [0]
+  with profiling.phase("encode", sheet):
+    if sheet in PATH_SHEETS:
+      pt_ph_writer(writer, table, sections, sheet)
     else:
-      writer.write_byte_s(data[0:13])
-      writer.write_uint16(0)
-
-
-def object_writer(writer:BinaryWriter, df:pd.DataFrame):
-  writer.write_uint16_s([len(df.index), 0])
-  for i in df.index:
-    data = df.iloc[i].tolist()
-    object_id = data[:3]
-    reference = data[3]
-    vec = data[4:13]
-    route_settings = data[13:22]
-    presence_flags = data[22:27]
-
-    writer.write_objects(object_id, i, bool(presence_flags[0]))
-    writer.write_hex(reference)
-    writer.write_float_s(vec)
-    writer.write_uint16_s(route_settings)
-    writer.write_reference(presence_flags)
-
-
-def poti_writer(writer:BinaryWriter, df:pd.DataFrame):
-  idx_1, idx_2 = get_idx(df["ID"].isnull(), df.index)
-
-  writer.write_uint16_s([len(idx_1)-1, len(df.index)])
-  k = 0
-  for i in range(len(idx_1)-1):
-    writer.write_uint16(idx_2[i])
-    writer.write_byte_s(df.iloc[k, 1:3].tolist())
-    for j in range(idx_2[i]):
-      data = df.iloc[k+j].tolist()
-      writer.write_float_s(data[3:6])
-      writer.write_uint16_s(data[6:8])
-    k += idx_2[i]
-
-
-def came_writer(writer:BinaryWriter, df:pd.DataFrame):
-  writer.write_uint16(len(df.index))
-  writer.write_byte(df["First1"].tolist().index(1))
-  writer.write_byte(df["First2"].tolist().index(1))
-  for i in df.index:
-    data = df.iloc[i].tolist()
-    writer.write_byte_s([data[0], data[3], 0, data[4]])
-    writer.write_uint16_s(data[5:8])
-    writer.write_byte_s([0,0])
-    writer.write_float_s(data[8:23])
-
-
-def other_writer(writer:BinaryWriter, df:pd.DataFrame, sheet:str):
-  writer.write_uint16_s([len(df.index), 0])
-  for i in df.index:
-    data = df.iloc[i].tolist()
-    if sheet == "KTPT":
-      writer.write_float_s(data[:6])
-      writer.write_int16(data[6])
-      writer.write_uint16(0)
-    elif sheet == "AREA":
-      writer.write_byte_s(data[:4])
-      writer.write_float_s(data[4:13])
-      writer.write_uint16_s(data[13:15])
-      writer.write_byte_s(data[15:17])
-      writer.write_uint16(0)
-    elif sheet == "JGPT":
-      writer.write_float_s(data[:6])
-      writer.write_uint16(0)
-      writer.write_int16(data[6])
-    elif sheet == "CNPT":
-      writer.write_float_s(data[:6])
-      writer.write_uint16(data[6])
-      writer.write_int16(data[7])
-    elif sheet == "MSPT":
-      writer.write_float_s(data[:6])
-      writer.write_uint16_s([data[6], 0])
-
-
-def excel_convert(path, output):
-  sheets = ["KTPT", "ENPT+ENPH", "ITPT+ITPH", "CKPT+CKPH", "GOBJ", "POTI", "AREA", "CAME", "JGPT", "CNPT", "MSPT", "STGI"]
-  target = dict(zip(sheets[1:4], ["ENPH ID", "ITPH ID", "CKPH ID"]))
-  with open(output, "wb") as f:
-    writer = BinaryWriter(f)
-
-    # Header
-    writer.write_string('RKMD')
-    writer.write_uint32(0)
-    writer.write_uint16(15)
-    writer.write_uint16(76)
-    writer.write_uint32(2520)
-    writer.write_uint32_s([0]*15)
-
-    sections = []
-    for sheet in sheets:
-      sections.append(writer.getaddress - 76)
-      df = pd.read_excel(path, sheet_name=sheet, engine="openpyxl")
-      df = df.drop("Unnamed: 0", axis=1)
-
-      if sheet in target.keys():
-        pt_ph_writer(writer, df, sections, list(target.keys()).index(sheet), target[sheet])
+      writer.write_string(sheet)
+      if sheet == "POTI":
+        poti_writer(writer, table)
+      elif sheet == "GOBJ":
+        object_writer(writer, table)
+      elif sheet == "CAME":
+        came_writer(writer, table)
+      else:
+        other_writer(writer, table, sheet)
+  sections.append(writer.getaddress)
+  data = writer.getvalue()
+  return [data[sections[i]:sections[i+1]] for i in range(len(sections)-1)]
+
+
+def build_kmp(sections:list, version:int=VERSION) -> bytes:
+  """
+  [section bytes] -> KMP (header, offset table and sections)
+  The offsets and the file length come from the section lengths, everything is joined in one pass.
+  """
+  lengths = [len(x) for x in sections]
+  header_length = FILE_HEADER.size + 4*len(sections)
+  header = FILE_HEADER.pack(b"RKMD", header_length + sum(lengths), len(sections), header_length, version)
+  offsets = pack(">%dI" % len(sections), *accumulate([0] + lengths[:-1])) if len(sections) > 0 else b""
+  return b"".join([header, offsets] + list(sections))
+
+
+def section_name(data:bytes) -> str:
+  return str(data[:4], encoding="utf-8", errors="replace")
+
+
+def splice_kmp(kmp:bytes, replaced:dict) -> bytes:
+  """
+  KMP, {section name: section bytes} -> KMP with only these sections replaced
+  The other sections are copied as they are, the offset table and the file length are rebuilt.
+  """
+  with MappedParser(kmp) as parser:
+    sections = [
+        replaced.get(name, bytes(parser.buffer[address-SECTION_HEADER.size:end]))
+        for name, entry, option, address, end in parser.sections()]
+    version = parser.version
+  return build_kmp(sections, version)
+
+
+def encode_cached(sheet:str, table:dict, cache:Cache=None) -> list:
+  """
+  encode_sheet, reusing the section bytes of an unchanged sheet
+  """
+  if cache is None:
+    return encode_sheet(sheet, table)
+  with profiling.phase("cache", sheet):
+    key = cache.key("x2k-sheet", sheet, table_digest(table))
+    sections = cache.get_object(key)
+  if sections is None:
+    sections = encode_sheet(sheet, table)
+    cache.put_object(key, sections)
+  return sections
+
+
+def write_output(output, data:bytes, szs:str=None, level:int=1):
+  """
+  output ending with .szs : the KMP of szs (default: output) is replaced, the other files are kept
+  level : Yaz0 compression level of the SZS
+  """
+  with profiling.phase("output"):
+    if output.lower().endswith(".szs"):
+      data = replace_kmp(output if szs is None else szs, data, level=level)
+    profiling.count("write", len(data))
+    with open(output, "wb") as f:
+      f.write(data)
+
+
+def tables_to_kmp(tables, cache:Cache=None, validate:bool=True) -> bytes:
+  """
+  {sheet name: DataFrame or table} (or (sheet, table) pairs) -> KMP bytes
+  validate : every sheet is checked before encoding (ValueError listing all the problems)
+  """
+  if hasattr(tables, "items"):
+    tables = tables.items()
+  tables = [(sheet, table if isinstance(table, dict) else frame_to_table(table)) for sheet, table in tables]
+  if validate:
+    check_tables(tables)
+  sections = []
+  for sheet, table in tables:
+    sections += encode_cached(sheet, table, cache)
+  with profiling.phase("assemble"):
+    return build_kmp(sections)
+
+
+def excel_to_kmp(source, engine=None, cache:Cache=None, validate:bool=True) -> bytes:
+  """
+  xlsx (path, bytes or binary file-like object) -> KMP bytes
+  """
+  return tables_to_kmp(iter_tables(source, list(SHEETS.keys()), "xlsx", engine), cache, validate)
+
+
+def excel_convert(path, output, engine=None, fmt=None, cache:Cache=None, szs:str=None, level:int=1,
+                  validate:bool=True):
+  if cache is not None:
+    with profiling.phase("cache"):
+      key = cache.key("x2k", file_digest(path), fmt, engine, validate)
+      data = cache.get(key)
+    if data is not None:
+      write_output(output, data, szs, level)
+      return
+
+  data = tables_to_kmp(iter_tables(path, list(SHEETS.keys()), fmt, engine), cache, validate)
+
+  if cache is not None:
+    cache.put(key, data)
+  write_output(output, data, szs, level)
+
+
+def source_stamp(path:str) -> tuple:
+  """
+  file or tables directory -> (name, mtime, size) of its files
+  """
+  paths = [path]
+  if os.path.isdir(path):
+    paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+  stamp = []
+  for p in paths:
+    try:
+      stat = os.stat(p)
+      stamp.append((p, stat.st_mtime_ns, stat.st_size))
+    except FileNotFoundError: # being replaced by the editor
+      stamp.append((p, None, None))
+  return tuple(stamp)
+
+
+def watch(path, output, engine=None, fmt=None, szs:str=None, level:int=0, interval:float=0.5, debounce:float=0.3,
+          validate:bool=True):
+  """
+  Rebuild output each time the tables are saved (polling every interval, once unchanged for debounce seconds).
+  Only the sheets whose content changed are encoded again and spliced into the previous KMP.
+  level : Yaz0 level of an output .szs (0 by default : each save is written at once)
+  """
+  sheets = {} # sheet -> (table digest, [section bytes])
+  kmp = None
+  last = None
+  print(f"watching {path} (Ctrl+C to stop)")
+  while True:
+    stamp = source_stamp(path)
+    if stamp == last:
+      time.sleep(interval)
+      continue
+    time.sleep(debounce)
+    if source_stamp(path) != stamp:
+      continue
+    last = stamp
+    start = time.perf_counter()
+    try:
+      changed = {}
+      tables = list(iter_tables(path, list(SHEETS.keys()), fmt, engine))
+      if validate:
+        check_tables(tables)
+      for sheet, table in tables:
+        digest = table_digest(table)
+        if sheet not in sheets or sheets[sheet][0] != digest:
+          changed[sheet] = (digest, encode_sheet(sheet, table))
+      if len(changed) == 0:
+        continue
+      if kmp is None:
+        data = build_kmp(sum([changed[sheet][1] for sheet in SHEETS], []))
       else:
-        writer.write_string(sheet)
-        if sheet == "POTI":
-          poti_writer(writer, df)
-        elif sheet == "GOBJ":
-          object_writer(writer, df)
-        elif sheet == "CAME":
-          came_writer(writer, df)
-        elif sheet == "STGI":
-          writer.write_uint16_s([len(df.index), 0])
-          data = df.iloc[0].tolist()
-          writer.write_byte_s(data[:4] + [0] + data[4:8] + [0])
-          writer.write_float_half(data[8])
-        else:
-          other_writer(writer, df, sheet)
-  
-    address = writer.getaddress
-    writer.seek(4)
-    writer.write_uint32(address)
-    writer.seek(16)
-    writer.write_uint32_s(sections)
+        data = splice_kmp(kmp, {section_name(x): x for digest, sections in changed.values() for x in sections})
+      write_output(output, data, szs, level)
+    except Exception as e:
+      print(f"{path} : FAILED ({type(e).__name__}: {e})")
+      continue
+    kmp = data
+    sheets.update(changed)
+    print(f"{', '.join(changed)} -> {output} ({time.perf_counter()-start:.2f}s)")
 
 
 if __name__ == "__main__":
   parser = argparse.ArgumentParser()
-  parser.add_argument('--excel', required=True, help='Excel file')
-  parser.add_argument('--kmp', required=True, help='Output KMP path')
+  parser.add_argument('--excel', required=True, help='Excel file (or tables directory), directory or glob')
+  parser.add_argument('--kmp', default=None,
+      help='Output KMP path (output directory for batch), .szs replaces course.kmp in the archive')
+  parser.add_argument('--szs', default=None, help='Archive holding the other files of an output .szs (default: the output)')
+  parser.add_argument('--szs-level', type=int, default=None, choices=[0, 1],
+      help='Yaz0 level of an output .szs (0: fast, no compression, default for --watch and batch, else 1)')
+  parser.add_argument('--engine', default=None, choices=['openpyxl', 'calamine'],
+      help='Excel reader (default: calamine if installed, else openpyxl)')
+  parser.add_argument('-f', '--format', default=None, choices=FORMATS,
+      help='Input format (default: from the path)')
+  parser.add_argument('-j', '--jobs', type=int, default=1, help='Worker processes for batch')
+  parser.add_argument('--cache-dir', default=None, help='Conversion cache directory (disabled if not given)')
+  parser.add_argument('--cache-size', type=int, default=1024, help='Cache size limit (MB)')
+  parser.add_argument('--profile', nargs='?', const='-', default=None,
+      help='Write a JSON profile (time, I/O, peak memory per section and phase) to this path (default: stdout)')
+  parser.add_argument('--cprofile', default=None, help='Write cProfile stats to this path')
+  parser.add_argument('--watch', action='store_true',
+      help='Rebuild the KMP each time the tables are saved (only changed sheets are encoded again)')
+  parser.add_argument('--interval', type=float, default=0.5, help='Polling interval of --watch (seconds)')
+  parser.add_argument('--no-daemon', action='store_true',
+      help='Convert in this process even if a daemon (daemon.py) is running')
+  parser.add_argument('--check', action='store_true',
+      help='Only validate the tables (types, ranges, links) and print every problem, nothing is written')
+  parser.add_argument('--no-validate', action='store_true',
+      help='Encode without validating the tables first (dangling links are written as they are)')
   parser.add_argument('-o', '--overwrite', action='store_true', dest='o', 
       help='If enabled, allows overwriting.')
 
   arg = parser.parse_args()
+  cache = None if arg.cache_dir is None else Cache(arg.cache_dir, arg.cache_size << 20)
+  profiled = {"report": arg.profile, "cprofile": arg.cprofile}
+  if arg.jobs > 1 and (arg.profile is not None or arg.cprofile is not None):
+    parser.error("--profile and --cprofile need --jobs 1.")
+
+  batch = is_batch(arg.excel) and not is_tables_dir(arg.excel)
+  if arg.szs_level is None:
+    arg.szs_level = 0 if batch or arg.watch else 1
+  suffix = "." + (arg.format or "xlsx")
+  if arg.check:
+    paths = expand_paths(arg.excel, ".kmp" + suffix) if batch else [arg.excel]
+    sys.exit(int(validate_files(paths, arg.jobs, arg.format, arg.engine) > 0))
+
+  if batch:
+    if arg.kmp is not None:
+      os.makedirs(arg.kmp, exist_ok=True)
+    pairs = [(src, output_path(src, arg.kmp, suffix, "")) for src in expand_paths(arg.excel, ".kmp" + suffix)]
+    args = (arg.engine, arg.format, cache, None, arg.szs_level, not arg.no_validate)
+    results = profiling.run(run_batch, excel_convert, pairs, arg.jobs, arg.o, args, **profiled)
+    sys.exit(int(any(x[2] is not None for x in results)))
+
+  if arg.kmp is None:
+    parser.error("--kmp is required for a single file.")
 
   if not arg.o and os.path.exists(arg.kmp):
     raise FileExistsError(arg.kmp + " arleady exists.")
-
-  excel_convert(arg.excel, arg.kmp)
+  if arg.kmp.lower().endswith(".szs") and arg.szs is None and not os.path.exists(arg.kmp):
+    parser.error("--szs is required to write a new .szs.")
+
+  if arg.watch:
+    try:
+      watch(arg.excel, arg.kmp, arg.engine, arg.format, arg.szs, arg.szs_level, arg.interval,
+            validate=not arg.no_validate)
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
+
+  options = {
+      "format": arg.format, "engine": arg.engine, "overwrite": arg.o,
+      "cache_dir": arg.cache_dir, "cache_size": arg.cache_size, "szs": arg.szs, "szs_level": arg.szs_level,
+      "validate": not arg.no_validate}
+  if arg.no_daemon or arg.profile is not None or arg.cprofile is not None or not forward("x2k", arg.excel, arg.kmp, **options):
+    profiling.run(
+        excel_convert, arg.excel, arg.kmp, arg.engine, arg.format, cache, arg.szs, arg.szs_level,
+        not arg.no_validate, **profiled)
   print(f"{arg.excel} -> {arg.kmp}")